@@ -8,18 +8,30 @@ lowercases filenames, and tries to notify user on success.\n\
 Please refer to https://github.com/novoid/fetchphotos for more information.\n"""
 
 #from PIL.ExifTags import TAGS
-from PIL import Image
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 from datetime import datetime
 import ConfigParser  ## for configuration files
 import codecs    # for handling Unicode content in config files
+import collections
+import contextlib
 import ctypes
+import errno
+import fcntl
+import hashlib
+import io
 import itertools
+import json
 import logging
+import math
 import os
+import Queue
 import re
-import shutil
+import select
+import stat
+import struct
 import sys
+import tempfile
+import threading
 import time
 
 try:
@@ -30,15 +42,50 @@ except ImportError:
         "or \"apt-get install python-appdirs\"."
     sys.exit(1)
 
+## scandir (part of os in Python 3.5+) saves a stat() call per file
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = getattr(os, 'scandir', None)
+
 #-------------------------------------------------------------------------
 class FetchphotosConfig(object):
     """Handles configuration parsing for Fetchphotos"""
 
-    def __init__(self, logger, requested_filename, gen_file=False):
+    ## values for settings which are not given in the configuration file
+    DEFAULTS = {
+        (u'General', u'SKIP_FETCHED'): u'false',
+        (u'General', u'INDEX_FILE'): u'',
+        (u'General', u'INDEX_HASH'): u'false',
+        (u'General', u'SKIP_DUPLICATES'): u'false',
+        (u'General', u'JOURNAL'): u'false',
+        (u'General', u'METADATA_CACHE_SIZE'): u'20000',
+        (u'General', u'SKIP_FETCHED_DIRECTORIES'): u'false',
+        (u'General', u'IMAGE_EXTENSIONS'): u'jpg jpeg',
+        (u'General', u'VIDEO_EXTENSIONS'): u'',
+        (u'General', u'READ_AHEAD_FILES'): u'4',
+        (u'General', u'READ_AHEAD_MB'): u'256',
+        (u'File_processing', u'ROTATE_PHOTOS'): u'true',
+        (u'File_processing', u'ADD_TIMESTAMP'): u'true',
+        (u'File_processing', u'LOWERCASE_FILENAME'): u'true',
+        (u'File_processing', u'KEEP_ORIGINALS'): u'true',
+        (u'File_processing', u'REMOVE_ORIGINALS'): u'directory',
+        (u'File_processing', u'LOSSLESS_ROTATION'): u'perfect',
+        (u'File_processing', u'DECODE_MEMORY_MB'): u'0',
+        (u'File_processing', u'THUMBNAIL_SIZES'): u'',
+        (u'File_processing', u'THUMBNAIL_DIR'): u'',
+        (u'File_processing', u'DESTINATION_LAYOUT'): u'',
+        (u'File_processing', u'MANIFEST'): u'false',
+    }
+
+    def __init__(self, logger, requested_filename, gen_file=False, wait_for_sourcedir=False):
+        """With <wait_for_sourcedir>, DIGICAMDIR does not have to exist yet
+        (for --watch).
+        """
         self.logger = logger
+        self.wait_for_sourcedir = wait_for_sourcedir
         self._cfgname = self.set_config_filename(requested_filename)
         self.config = None
-        print "gen_file is", gen_file
         if gen_file:
             self.generate_configfile()
         else:
@@ -71,12 +118,43 @@ class FetchphotosConfig(object):
 
         return cfgname
 
+    def __getstate__(self):
+        """Loggers can't be pickled; we pass on the logger name instead."""
+        state = self.__dict__.copy()
+        state['logger'] = self.logger.name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.logger = logging.getLogger(state['logger'])
+
     def get(self, *args):
         return self.config.get(*args)
 
     def getboolean(self, *args):
         return self.config.getboolean(*args)
 
+    def getint(self, *args):
+        return self.config.getint(*args)
+
+    def get_rotation_mode(self):
+        """Interpret ROTATE_PHOTOS: returns 'rotate', 'metadata' (only set
+        the EXIF orientation tag) or 'none'.
+        """
+        if self.get(u'File_processing', u'ROTATE_PHOTOS').lower() == u'metadata':
+            return u'metadata'
+        elif self.getboolean(u'File_processing', u'ROTATE_PHOTOS'):
+            return u'rotate'
+        else:
+            return u'none'
+
+    def get_removal_mode(self):
+        """Interpret REMOVE_ORIGINALS: returns 'file', 'directory' or 'end'."""
+        mode = self.get(u'File_processing', u'REMOVE_ORIGINALS').lower()
+        if mode not in (u'file', u'directory', u'end'):
+            raise ConfigParser.Error(u"REMOVE_ORIGINALS must be 'file', 'directory' or 'end'")
+        return mode
+
     def cfgname(self):
         return self._cfgname
 
@@ -107,12 +185,76 @@ class FetchphotosConfig(object):
             # directory, where the photos will be moved to
             DESTINATIONDIR=/path-to-destination -- replace me!
 
+            # extensions of the files to fetch (in DIGICAMDIR and its subdirectories)
+            IMAGE_EXTENSIONS=jpg jpeg
+            VIDEO_EXTENSIONS=
+
+            # remember the fetched files, and skip them in later runs
+            # can be one of 'true' or 'false'
+            SKIP_FETCHED=false
+
+            # don't even look into directories which were completely fetched
+            # before, and did not change since (needs SKIP_FETCHED=true)
+            # can be one of 'true' or 'false'
+            SKIP_FETCHED_DIRECTORIES=false
+
+            # file for remembering the fetched files (default: next to this file)
+            #INDEX_FILE=/path-to/fetchphotos-index.sqlite
+
+            # also recognise fetched files by their content
+            # can be one of 'true' or 'false'
+            INDEX_HASH=false
+
+            # skip files whose content is already in DESTINATIONDIR
+            # can be one of 'true' or 'false'
+            SKIP_DUPLICATES=false
+
+            # keep a journal (in INDEX_FILE) of the files of a run, so that an
+            # interrupted run can be continued where it stopped
+            # can be one of 'true' or 'false'
+            JOURNAL=false
+
+            # remember the orientation and time of this many files (in
+            # INDEX_FILE), so that they are not read again by the next run
+            # (0: don't remember them)
+            METADATA_CACHE_SIZE=20000
+
+            # read up to this many files (and megabytes) from DIGICAMDIR ahead,
+            # while the current file is written to DESTINATIONDIR (0: off)
+            READ_AHEAD_FILES=4
+            READ_AHEAD_MB=256
+
             [File_processing]
 
             # rotate the photos according to EXIF data saved from the digicam
-            # can be one of 'true' or 'false'
+            # can be one of 'true', 'false' or 'metadata' (don't rotate the
+            # image, keep its EXIF orientation and only reset invalid values)
             ROTATE_PHOTOS=true
 
+            # rotate JPEG files without recompressing them, using jpegtran
+            # can be one of 'perfect' (only if the image size allows it),
+            # 'trim' (drop partial blocks at the edges) or 'false'
+            LOSSLESS_ROTATION=perfect
+
+            # put the files into subdirectories of DESTINATIONDIR by date,
+            # with strftime directives (default: no subdirectories)
+            # example: %Y/%m/%d puts a file into DESTINATIONDIR/2009/12/31/
+            DESTINATION_LAYOUT=
+
+            # write the SHA-1 hashes of the fetched files of each run to
+            # DESTINATIONDIR/.manifests/ (check them with "sha1sum -c")
+            # can be one of 'true' or 'false'
+            MANIFEST=false
+
+            # write previews with these sizes (in pixels, separated by blanks)
+            # into THUMBNAIL_DIR/<size>/ (default: DESTINATIONDIR/.thumbnails)
+            THUMBNAIL_SIZES=
+            #THUMBNAIL_DIR=/path-to/thumbnails
+
+            # memory (in MB) that all running fetchphotos processes together
+            # may use for rotating images; 0 means no limit
+            DECODE_MEMORY_MB=0
+
             # add timestamp according to ISO 8601+ http://datestamp.org/index.shtml
             # can be one of 'true' or 'false'
             # example: if true, file 'foo.jpg' will end up in '2009-12-31T23.59.59_foo.jpg'
@@ -130,6 +272,10 @@ class FetchphotosConfig(object):
             # does what you want.
             KEEP_ORIGINALS=true
 
+            # without KEEP_ORIGINALS, remove the originals after each 'file',
+            # after each 'directory' or at the 'end'
+            REMOVE_ORIGINALS=directory
+
             """, flags=re.MULTILINE))
 
         self.logger.info("A configuration file has been created in %s",
@@ -149,6 +295,12 @@ class FetchphotosConfig(object):
                               self.cfgname())
             raise
 
+        for (section, option), value in self.DEFAULTS.iteritems():
+            if not config.has_section(section):
+                config.add_section(section)
+            if not config.has_option(section, option):
+                config.set(section, option, value)
+
         return config
 
     def check_sourcedir(self):
@@ -160,7 +312,7 @@ class FetchphotosConfig(object):
                                  self.cfgname())
                 self.logger.info(u" where the digicam photos are located (not /path-to-images)")
                 self.config = None
-            elif not os.path.exists(digicamdir):
+            elif not os.path.exists(digicamdir) and not self.wait_for_sourcedir:
                 raise IOError(ctypes.get_errno(),
                               u"The digicam photo directory \"{}\" does not exist".format(
                                   digicamdir))
@@ -202,44 +354,1203 @@ class FetchphotosConfig(object):
         """Return the (valid) destination directory."""
         return self._destdir
 
+    def get_extensions(self):
+        """Return the (lowercase) extensions of the files to fetch, from
+        IMAGE_EXTENSIONS and VIDEO_EXTENSIONS.  The extensions may be
+        separated by blanks or commas.
+        """
+        extensions = []
+        for option in (u'IMAGE_EXTENSIONS', u'VIDEO_EXTENSIONS'):
+            for extension in re.split(r'[\s,]+', self.get(u'General', option)):
+                extension = extension.lstrip(u'.').lower()
+                if extension:
+                    extensions.append(extension)
+
+        return extensions
+
+    def get_destination_layout(self):
+        """Return the DESTINATION_LAYOUT template (without interpolation,
+        as it contains strftime directives).
+        """
+        return self.config.get(u'File_processing', u'DESTINATION_LAYOUT', raw=True)
+
+    def get_thumbnail_sizes(self):
+        """Return the sizes from THUMBNAIL_SIZES, largest first."""
+        return sorted((int(size) for size in
+                       re.split(r'[\s,]+', self.get(u'File_processing', u'THUMBNAIL_SIZES'))
+                       if size), reverse=True)
+
+    def get_thumbnail_dir(self):
+        """Return the directory for the thumbnails (by default, .thumbnails
+        in the destination directory).
+        """
+        thumbnail_dir = self.get(u'File_processing', u'THUMBNAIL_DIR')
+        if not thumbnail_dir:
+            thumbnail_dir = os.path.join(self.get_destdir(), u'.thumbnails')
+        return thumbnail_dir
+
+    def get_index_filename(self):
+        """Return the name of the index of fetched files.  Unless set in
+        the configuration file, it is located next to the configuration file.
+        """
+        index_file = self.get(u'General', u'INDEX_FILE')
+        if not index_file:
+            index_file = os.path.join(os.path.dirname(os.path.abspath(self.cfgname())),
+                                      u'fetchphotos-index.sqlite')
+        return index_file
+
+#-------------------------------------------------------------------------
+class SQLiteIndex(object):
+    """Common code for the indexes fetchphotos keeps in its SQLite file."""
+
+    ## number of changes after which the index is written to disk
+    COMMIT_INTERVAL = 100
+
+    ## the indexes in the same file share a connection (two connections
+    ## with pending changes would lock each other out): filename ->
+    ## [connection, number of users]
+    connections = {}
+
+    def __init__(self, filename, logger):
+        import sqlite3
+
+        self.logger = logger
+        self.pending = 0
+        self.filename = os.path.abspath(filename)
+
+        self.logger.debug(u"Opening %s in %s", self.__class__.__name__, filename)
+        if self.filename not in SQLiteIndex.connections:
+            SQLiteIndex.connections[self.filename] = [sqlite3.connect(filename), 0]
+        SQLiteIndex.connections[self.filename][1] += 1
+        self.db = SQLiteIndex.connections[self.filename][0]
+
+    def changed(self):
+        """Count a change, and commit if there are enough of them."""
+        self.pending += 1
+        if self.pending >= self.COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        """Write the pending entries to disk."""
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        """Commit and close the index."""
+        self.commit()
+        SQLiteIndex.connections[self.filename][1] -= 1
+        if not SQLiteIndex.connections[self.filename][1]:
+            del SQLiteIndex.connections[self.filename]
+            self.db.close()
+
+class IngestIndex(SQLiteIndex):
+    """Remembers the files that were fetched in earlier runs, so they can
+    be skipped.  Files are identified by their path, size and modification
+    time, and optionally by a hash of their content (which also recognises
+    files that are seen under a different path, e.g. when the card is
+    mounted somewhere else).
+    """
+
+    def __init__(self, filename, logger, use_hash=False):
+        super(IngestIndex, self).__init__(filename, logger)
+        self.use_hash = use_hash
+
+        self.db.execute(u"""CREATE TABLE IF NOT EXISTS fetched (
+                              source TEXT NOT NULL,
+                              size INTEGER NOT NULL,
+                              mtime REAL NOT NULL,
+                              hash TEXT,
+                              destination TEXT NOT NULL,
+                              fetched TEXT NOT NULL,
+                              PRIMARY KEY (source, size, mtime))""")
+        self.db.execute(u"CREATE INDEX IF NOT EXISTS fetched_hash ON fetched (hash)")
+        self.db.execute(u"""CREATE TABLE IF NOT EXISTS directories (
+                              path TEXT PRIMARY KEY,
+                              mtime REAL NOT NULL,
+                              entries INTEGER NOT NULL)""")
+
+    def contains(self, fpfile):
+        """Return the destination of <fpfile> if it was fetched before,
+        None otherwise.
+        """
+        row = self.db.execute(
+            u"SELECT destination FROM fetched WHERE source=? AND size=? AND mtime=?",
+            (os.path.abspath(fpfile.path), fpfile.size, fpfile.mtime)).fetchone()
+
+        if row is None and self.use_hash:
+            row = self.db.execute(
+                u"SELECT destination FROM fetched WHERE hash=? AND size=?",
+                (fpfile.get_content_hash(), fpfile.size)).fetchone()
+
+        if row is None:
+            return None
+
+        return row[0]
+
+    def add(self, fpfile):
+        """Record that <fpfile> has been fetched."""
+        if self.use_hash:
+            content_hash = fpfile.get_content_hash()
+        else:
+            content_hash = None
+
+        self.db.execute(u"INSERT OR REPLACE INTO fetched VALUES (?, ?, ?, ?, ?, ?)",
+                        (os.path.abspath(fpfile.path), fpfile.size, fpfile.mtime,
+                         content_hash, fpfile.get_new_filename(),
+                         datetime.now().isoformat()))
+        self.changed()
+
+    def is_imported_directory(self, directory, mtime, entries):
+        """Return True if <directory> was completely fetched before, and
+        neither its modification time nor its number of entries changed.
+        """
+        return self.db.execute(
+            u"SELECT 1 FROM directories WHERE path=? AND mtime=? AND entries=?",
+            (os.path.abspath(directory), mtime, entries)).fetchone() is not None
+
+    def add_directory(self, directory, mtime, entries):
+        """Record that all files in <directory> have been fetched."""
+        self.db.execute(u"INSERT OR REPLACE INTO directories VALUES (?, ?, ?)",
+                        (os.path.abspath(directory), mtime, entries))
+        self.changed()
+
+class IngestJournal(SQLiteIndex):
+    """Records how far each file of the current run got, so that a run
+    after an interruption does not do the same work again.  A file is
+    - discovered: it is going to be fetched
+    - copied: its destination has its final name, and its content is on disk
+    - verified: its destination was checked
+    - removed: its source was removed
+    The journal is emptied when a run is complete.
+    """
+
+    DISCOVERED = u'discovered'
+    COPIED = u'copied'
+    VERIFIED = u'verified'
+    REMOVED = u'removed'
+
+    def __init__(self, filename, logger):
+        super(IngestJournal, self).__init__(filename, logger)
+
+        self.db.execute(u"""CREATE TABLE IF NOT EXISTS journal (
+                              source TEXT NOT NULL,
+                              size INTEGER NOT NULL,
+                              mtime REAL NOT NULL,
+                              destination TEXT,
+                              written INTEGER,
+                              state TEXT NOT NULL,
+                              PRIMARY KEY (source, size, mtime))""")
+
+    def get(self, fpfile):
+        """Return the state, the destination and its size of <fpfile> from
+        an earlier run, or (None, None, None).
+        """
+        row = self.db.execute(
+            u"SELECT state, destination, written FROM journal WHERE source=? AND size=? AND mtime=?",
+            (os.path.abspath(fpfile.path), fpfile.size, fpfile.mtime)).fetchone()
+
+        if row is None:
+            return None, None, None
+
+        return row
+
+    def set_state(self, fpfile, state, source=None):
+        """Record that <fpfile> has reached <state>.  <source> is needed once
+        the source was removed (and fpfile.path is None).  The states from
+        copied on are committed right away, so they survive a crash; a
+        source is only removed after its verified state is on disk.
+        Discovered files are written with the next commit.
+        """
+        self.db.execute(u"INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?, ?)",
+                        (os.path.abspath(source or fpfile.path), fpfile.size, fpfile.mtime,
+                         fpfile.get_new_filename() or None, fpfile.written or None, state))
+        if state in (self.COPIED, self.VERIFIED, self.REMOVED):
+            self.commit()
+        else:
+            self.changed()
+
+    def clear(self):
+        """Forget all files, after a complete run."""
+        self.db.execute(u"DELETE FROM journal")
+        self.commit()
+
+class MetadataCache(SQLiteIndex):
+    """Remembers the orientation and the time of the files seen in earlier
+    runs (like a dry run before the real one), so that their metadata is
+    not read again.  Files are identified by their device, inode, size and
+    modification time.  Only the <size> most recently used entries are kept.
+    """
+
+    def __init__(self, filename, logger, size):
+        super(MetadataCache, self).__init__(filename, logger)
+        self.size = size
+
+        self.db.execute(u"""CREATE TABLE IF NOT EXISTS metadata (
+                              device INTEGER NOT NULL,
+                              inode INTEGER NOT NULL,
+                              size INTEGER NOT NULL,
+                              mtime REAL NOT NULL,
+                              orientation INTEGER NOT NULL,
+                              time TEXT NOT NULL,
+                              used REAL NOT NULL,
+                              PRIMARY KEY (device, inode, size, mtime))""")
+        self.db.execute(u"CREATE INDEX IF NOT EXISTS metadata_used ON metadata (used)")
+
+    def get(self, fpfile):
+        """Return the orientation and the time of <fpfile>, or None."""
+        row = self.db.execute(
+            u"SELECT orientation, time FROM metadata " +
+            u"WHERE device=? AND inode=? AND size=? AND mtime=?",
+            (fpfile.device, fpfile.inode, fpfile.size, fpfile.mtime)).fetchone()
+
+        if row is None:
+            return None
+
+        return row[0], datetime.strptime(row[1][:19], u"%Y-%m-%dT%H:%M:%S")
+
+    def add(self, fpfile):
+        """Remember the orientation and the time of <fpfile> (or that it was
+        used again).
+        """
+        self.db.execute(u"INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (fpfile.device, fpfile.inode, fpfile.size, fpfile.mtime,
+                         fpfile.orientation, fpfile.time.isoformat(), time.time()))
+        self.changed()
+
+    def close(self):
+        """Forget the least recently used entries beyond the size, and close
+        the cache.
+        """
+        count = self.db.execute(u"SELECT COUNT(*) FROM metadata").fetchone()[0]
+        if count > self.size:
+            self.db.execute(u"DELETE FROM metadata WHERE rowid IN " +
+                            u"(SELECT rowid FROM metadata ORDER BY used LIMIT ?)",
+                            (count - self.size,))
+        super(MetadataCache, self).close()
+
+class DestinationIndex(SQLiteIndex):
+    """Knows the content of the destination directory, so that files which
+    are already there byte for byte are not fetched again.
+
+    Files are compared by size first, then by a hash of their first
+    FPFileInfo.PARTIAL_HASH_SIZE bytes, and only then by a hash of their
+    complete content.  The hashes of files in the destination directory are
+    calculated when they are needed, and kept in the index.
+
+    The directory is scanned once; after that the index is kept up to date
+    with the files fetchphotos writes.
+    """
+
+    def __init__(self, filename, destdir, logger):
+        super(DestinationIndex, self).__init__(filename, logger)
+
+        self.db.execute(u"""CREATE TABLE IF NOT EXISTS destination (
+                              path TEXT PRIMARY KEY,
+                              size INTEGER NOT NULL,
+                              partial TEXT,
+                              hash TEXT)""")
+        self.db.execute(u"CREATE INDEX IF NOT EXISTS destination_size ON destination (size)")
+        self.db.execute(u"CREATE TABLE IF NOT EXISTS scanned (directory TEXT PRIMARY KEY)")
+
+        destdir = os.path.abspath(destdir)
+        if self.db.execute(u"SELECT 1 FROM scanned WHERE directory=?",
+                           (destdir,)).fetchone() is None:
+            self.scan(destdir)
+
+    def scan(self, destdir):
+        """Add all files in <destdir> (with their sizes) to the index."""
+        self.logger.info(u"Building the index of the files in %s", destdir)
+        for dirpath, dirnames, filenames in os.walk(destdir):
+            ## like .thumbnails
+            dirnames[:] = [name for name in dirnames if not name.startswith(u'.')]
+            for name in filenames:
+                if name.startswith(FPFileInfo.TEMPORARY_PREFIX):
+                    ## left over from an interrupted run
+                    continue
+                path = os.path.join(dirpath, name)
+                self.db.execute(u"INSERT OR IGNORE INTO destination VALUES (?, ?, NULL, NULL)",
+                                (path, os.path.getsize(path)))
+
+        self.db.execute(u"INSERT INTO scanned VALUES (?)", (destdir,))
+        self.commit()
+
+    def find_duplicate(self, fpfile):
+        """Return the name of a file in the destination directory with the
+        same content as <fpfile>, or None.
+        """
+        candidates = self.db.execute(
+            u"SELECT path, partial, hash FROM destination WHERE size=?",
+            (fpfile.size,)).fetchall()
+
+        for path, partial, content_hash in candidates:
+            if not os.path.isfile(path):
+                self.db.execute(u"DELETE FROM destination WHERE path=?", (path,))
+                self.changed()
+                continue
+
+            if partial is None:
+                partial = FPFileInfo.hash_file(path, FPFileInfo.PARTIAL_HASH_SIZE)
+                self.db.execute(u"UPDATE destination SET partial=? WHERE path=?",
+                                (partial, path))
+                self.changed()
+            if partial != fpfile.get_partial_hash():
+                continue
+
+            if content_hash is None:
+                content_hash = FPFileInfo.hash_file(path)
+                self.db.execute(u"UPDATE destination SET hash=? WHERE path=?",
+                                (content_hash, path))
+                self.changed()
+            if content_hash == fpfile.get_content_hash():
+                return path
+
+        return None
+
+    def add(self, fpfile):
+        """Record the destination of <fpfile>.  If the file was changed
+        on the way (rotated, or its orientation tag set), the size and hashes
+        of the source are recorded, as that is what would be fetched again.
+        A source which was moved and then changed exists no more; then the
+        destination is recorded as it is, and hashed when it is needed.
+        """
+        size = fpfile.size
+        if fpfile.get_rotation_type() and fpfile.moved:
+            size = fpfile.written
+            partial = content_hash = None
+        elif fpfile.get_rotation_type():
+            partial = fpfile.get_partial_hash()
+            content_hash = fpfile.get_content_hash()
+        else:
+            partial = fpfile.partial_hash
+            content_hash = fpfile.content_hash
+
+        self.db.execute(u"INSERT OR REPLACE INTO destination VALUES (?, ?, ?, ?)",
+                        (fpfile.get_new_filename(), size, partial, content_hash))
+        self.changed()
+
+#-------------------------------------------------------------------------
+class FileCopier(object):
+    """Copies files with as little work as the system allows.  In order,
+    it tries to
+    - clone the file (FICLONE, btrfs and XFS): only metadata is written
+    - copy_file_range() and sendfile(): the data stays in the kernel
+    - read and write in large blocks
+    The destination is preallocated, and gets the permission bits of the
+    source.
+    """
+
+    ## from <linux/fs.h>
+    FICLONE = 0x40049409
+
+    ## bytes per system call
+    CHUNK_SIZE = 8 * 1024 * 1024
+
+    ## from <fcntl.h>
+    POSIX_FADV_DONTNEED = 4
+
+    ## errors meaning "this way of copying is not supported here"
+    UNSUPPORTED = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+                   errno.ENOTTY, errno.EBADF)
+
+    ## the C library (False if the functions can't be used), loaded on first use
+    libc = None
+
+    @classmethod
+    def copy(cls, source, destination, digest=None, progress=None):
+        """Copy <source> to <destination>; returns the method used.  With a
+        hashlib object <digest>, the data is hashed on the way (this needs the
+        read/write loop, the data passes through fetchphotos).  <progress> is
+        called with the bytes copied so far and the size after each chunk.
+        """
+        with open(source, 'rb') as src:
+            status = os.fstat(src.fileno())
+            with open(destination, 'wb') as dst:
+                if digest is None:
+                    method = cls.copy_data(src.fileno(), dst.fileno(), status.st_size, progress)
+                else:
+                    method = cls.copy_hashed(src.fileno(), dst.fileno(), digest,
+                                             status.st_size, progress)
+                os.fchmod(dst.fileno(), stat.S_IMODE(status.st_mode))
+
+        return method
+
+    @classmethod
+    def copy_hashed(cls, src, dst, digest, size, progress=None):
+        """Copy between the file descriptors <src> and <dst>, and hash the
+        data with <digest>.
+        """
+        copied = 0
+        while True:
+            block = os.read(src, cls.CHUNK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+            os.write(dst, block)
+            copied += len(block)
+            if progress is not None:
+                progress(copied, size)
+
+        return u"read/write (hashed)"
+
+    @classmethod
+    def drop_cache(cls, filename):
+        """Drop the (written) data of <filename> from the page cache, so the
+        next read comes from the disk.
+        """
+        libc = cls.get_libc()
+        if not libc:
+            return False
+
+        descriptor = os.open(filename, os.O_RDONLY)
+        try:
+            return libc.posix_fadvise(descriptor, 0, 0, cls.POSIX_FADV_DONTNEED) == 0
+        finally:
+            os.close(descriptor)
+
+    @staticmethod
+    def sync(filename):
+        """Make sure the content of <filename> is written to disk."""
+        descriptor = os.open(filename, os.O_RDONLY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+    @classmethod
+    def copy_data(cls, src, dst, size, progress=None):
+        """Copy <size> bytes between the file descriptors <src> and <dst>."""
+        try:
+            fcntl.ioctl(dst, cls.FICLONE, src)
+            return u"reflink"
+        except IOError, ex:
+            if ex.errno not in cls.UNSUPPORTED:
+                raise
+
+        libc = cls.get_libc()
+        if libc:
+            ## fallocate() (unlike posix_fallocate()) fails instead of
+            ## writing zeros if the file system can't preallocate
+            if size and libc.fallocate(dst, 0, 0, size) != 0:
+                size_known = False
+            else:
+                size_known = True
+
+            for name in (u"copy_file_range", u"sendfile"):
+                copied = cls.kernel_copy(name, src, dst, size, progress)
+                if copied is not None:
+                    if copied != size and size_known:
+                        os.ftruncate(dst, copied)
+                    return name
+
+        copied = 0
+        while True:
+            block = os.read(src, cls.CHUNK_SIZE)
+            if not block:
+                break
+            os.write(dst, block)
+            copied += len(block)
+            if progress is not None:
+                progress(copied, size)
+        if copied != size:
+            ## preallocated, but the file got shorter
+            os.ftruncate(dst, copied)
+
+        return u"read/write"
+
+    @classmethod
+    def kernel_copy(cls, name, src, dst, size, progress=None):
+        """Copy with the C library function <name>.  Returns the number of
+        bytes copied, or None if the function can't be used for these files.
+        """
+        copied = 0
+        while copied < size:
+            count = min(cls.CHUNK_SIZE, size - copied)
+            if name == u"copy_file_range":
+                result = cls.libc.copy_file_range(src, None, dst, None, count, 0)
+            else:
+                result = cls.libc.sendfile(dst, src, None, count)
+
+            if result < 0:
+                error = ctypes.get_errno()
+                if copied == 0 and error in cls.UNSUPPORTED:
+                    return None
+                raise OSError(error, os.strerror(error))
+            elif result == 0:
+                if copied == 0 and size > 0:
+                    ## some file systems (like FUSE) say "nothing to copy"
+                    ## instead of failing: let the next way try
+                    return None
+                ## the file got shorter
+                break
+            copied += result
+            if progress is not None:
+                progress(copied, size)
+
+        return copied
+
+    @classmethod
+    def get_libc(cls):
+        """Load the C library functions, where available (Linux only)."""
+        if cls.libc is None:
+            cls.libc = False
+            if sys.platform.startswith('linux'):
+                try:
+                    libc = ctypes.CDLL(None, use_errno=True)
+                    libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                                               ctypes.c_int64, ctypes.c_int64]
+                    libc.copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                                                     ctypes.c_int, ctypes.c_void_p,
+                                                     ctypes.c_size_t, ctypes.c_uint]
+                    libc.copy_file_range.restype = ctypes.c_ssize_t
+                    libc.sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                                              ctypes.c_void_p, ctypes.c_size_t]
+                    libc.sendfile.restype = ctypes.c_ssize_t
+                    libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64,
+                                                   ctypes.c_int64, ctypes.c_int]
+                    cls.libc = libc
+                except AttributeError:
+                    pass
+
+        return cls.libc
+
+#-------------------------------------------------------------------------
+class SourceWatcher(object):
+    """Waits for new files in DIGICAMDIR (for --watch), and for DIGICAMDIR
+    itself to appear or to be mounted.  This uses inotify on Linux; where
+    that is not available, DIGICAMDIR is checked every POLL_INTERVAL seconds.
+    """
+
+    ## from <sys/inotify.h>
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_UNMOUNT = 0x00002000
+    IN_IGNORED = 0x00008000
+    IN_CLOEXEC = 0o2000000
+    EVENT = struct.Struct('iIII')
+
+    ## the events in DIGICAMDIR and its subdirectories
+    SOURCE_EVENTS = (IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF |
+                     IN_UNMOUNT)
+
+    ## seconds between checks of DIGICAMDIR (for mounts, and without inotify)
+    POLL_INTERVAL = 5
+
+    ## seconds without events before the new files are fetched
+    SETTLE_TIME = 1
+
+    def __init__(self, logger, directory):
+        self.logger = logger
+        self.directory = os.path.abspath(directory)
+        self.parent = os.path.dirname(self.directory)
+        self.watches = {}
+        self.device = self.get_device()
+
+        self.descriptor = None
+        self.libc = None
+        if sys.platform.startswith('linux'):
+            try:
+                libc = ctypes.CDLL(None, use_errno=True)
+                libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+                descriptor = libc.inotify_init1(self.IN_CLOEXEC)
+                if descriptor >= 0:
+                    self.descriptor = descriptor
+                    self.libc = libc
+            except AttributeError:
+                pass
+
+        if self.descriptor is None:
+            self.logger.info(u"inotify is not available, checking %s every %d seconds",
+                             self.directory, self.POLL_INTERVAL)
+        else:
+            self.add_watches()
+
+    def get_device(self):
+        """Return the device of DIGICAMDIR (None if it does not exist)."""
+        try:
+            return os.stat(self.directory).st_dev
+        except OSError:
+            return None
+
+    def add_watches(self):
+        """Watch the parent of DIGICAMDIR (for it to appear), and DIGICAMDIR
+        with all its subdirectories.  Directories watched already are not
+        added again.
+        """
+        watched = set(self.watches.values())
+        if self.parent not in watched:
+            self.add_watch(self.parent, self.IN_CREATE | self.IN_MOVED_TO)
+        for dirpath, dummy_dirnames, dummy_filenames in os.walk(self.directory):
+            if dirpath not in watched:
+                self.add_watch(dirpath, self.SOURCE_EVENTS)
+
+    def add_watch(self, directory, mask):
+        """Watch <directory> for the events in <mask>."""
+        watch = self.libc.inotify_add_watch(self.descriptor, directory.encode('utf-8'), mask)
+        if watch < 0:
+            self.logger.warning(u"can't watch %s: %s", directory,
+                                os.strerror(ctypes.get_errno()))
+        else:
+            self.watches[watch] = directory
+
+    def read_events(self):
+        """Return the directories with new files from the pending events."""
+        changed = set()
+        data = os.read(self.descriptor, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            watch, mask, dummy_cookie, length = self.EVENT.unpack_from(data, offset)
+            name = data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b'\0')
+            offset += self.EVENT.size + length
+
+            directory = self.watches.get(watch)
+            if mask & self.IN_IGNORED:
+                self.watches.pop(watch, None)
+            elif directory == self.parent:
+                if name.decode('utf-8') == os.path.basename(self.directory):
+                    changed.add(self.directory)
+            elif directory is not None:
+                changed.add(directory)
+
+        return changed
+
+    def wait(self):
+        """Block until there are new files.  Returns the directories to
+        look into, or None for all of DIGICAMDIR.  Directories which are
+        gone by then (deleted or moved away) are left out.
+        """
+        if self.descriptor is None:
+            time.sleep(self.POLL_INTERVAL)
+            return None
+
+        while True:
+            changed = set()
+            while True:
+                if changed:
+                    timeout = self.SETTLE_TIME
+                else:
+                    timeout = self.POLL_INTERVAL
+                if select.select([self.descriptor], [], [], timeout)[0]:
+                    changed.update(self.read_events())
+                elif changed:
+                    break
+                elif self.get_device() != self.device:
+                    ## mounted on an existing directory: there is no inotify event
+                    changed.add(self.directory)
+                    break
+
+            self.device = self.get_device()
+            self.add_watches()
+            if self.directory in changed:
+                return None
+
+            changed = set(directory for directory in changed if os.path.isdir(directory))
+            if changed:
+                ## the directories are scanned with their subdirectories
+                return [directory for directory in sorted(changed)
+                        if not any(directory.startswith(other + os.sep) for other in changed)]
+
+    def close(self):
+        """Stop watching."""
+        if self.descriptor is not None:
+            os.close(self.descriptor)
+            self.descriptor = None
+
+#-------------------------------------------------------------------------
+class ReadAhead(object):
+    """Reads the next source files in a background thread, while the
+    current file is being written to the destination, so the card reader
+    and the destination disk are busy at the same time.  The data only goes
+    to the page cache, where the copy (or the EXIF reader) finds it.
+
+    At most <window> files, and about <memory> bytes, are read ahead of the
+    file being processed.  Files on the device of the destination are not
+    read ahead; there is no second device to keep busy.  Neither are files
+    bigger than <memory> (like long videos).
+    """
+
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, logger, window, memory, destination_device):
+        self.logger = logger
+        self.window = window
+        self.memory = memory
+        self.destination_device = destination_device
+        self.consumed = 0
+        self.queue = Queue.Queue()
+
+        self.thread = threading.Thread(target=self.run, name=u"read-ahead")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def prefetch(self, fpfiles):
+        """Pass on <fpfiles>, reading ahead of the one being passed on."""
+        fpfiles = iter(fpfiles)
+        pending = collections.deque()
+        pending_bytes = 0
+        number = 0
+
+        while True:
+            while len(pending) < self.window and (not pending or pending_bytes < self.memory):
+                fpfile = next(fpfiles, None)
+                if fpfile is None:
+                    break
+
+                number += 1
+                pending.append((number, fpfile))
+                pending_bytes += fpfile.size
+                ## a file bigger than the memory would push itself out of the cache
+                if fpfile.device != self.destination_device and fpfile.size <= self.memory:
+                    self.queue.put((number, fpfile.path))
+
+            if not pending:
+                return
+
+            self.consumed, fpfile = pending.popleft()
+            pending_bytes -= fpfile.size
+            yield fpfile
+
+    def run(self):
+        """The background thread: read the queued files, unless their turn
+        has come already.
+        """
+        block = bytearray(self.BLOCK_SIZE)
+        while True:
+            number, path = self.queue.get()
+            if path is None:
+                return
+            if number <= self.consumed:
+                continue
+
+            try:
+                with io.open(path, 'rb', buffering=0) as source:
+                    while source.readinto(block):
+                        pass
+            except IOError, ex:
+                self.logger.debug(u"could not read ahead %s: %s", path, ex)
+
+    def close(self):
+        """Stop the background thread, and wait for it to finish (the
+        interpreter must not shut down under it).  Files still queued are
+        not read any more.
+        """
+        self.consumed = sys.maxint
+        self.queue.put((0, None))
+        self.thread.join()
+
+#-------------------------------------------------------------------------
+class DecodeBudget(object):
+    """Limits the memory used for decoding images to <megabytes>, across
+    the worker processes of this run and other fetchphotos runs on the same
+    machine (0 means no limit).
+
+    The budget is a lock file with one byte per megabyte.  A decode locks
+    as many bytes as it needs megabytes; the locks are fcntl byte-range
+    locks, which the system releases if a process dies.
+    """
+
+    ## seconds to wait before looking for free memory again
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, megabytes, filename=None):
+        self.megabytes = megabytes
+        if filename is None:
+            filename = os.path.join(tempfile.gettempdir(), u"fetchphotos-decode.lock")
+        self.filename = filename
+
+    @contextlib.contextmanager
+    def reserve(self, megabytes):
+        """Wait until <megabytes> are free, and keep them for the duration
+        of the with block.  Requests bigger than the budget wait until they
+        have the complete budget.
+        """
+        if self.megabytes <= 0:
+            yield
+            return
+
+        megabytes = max(1, min(megabytes, self.megabytes))
+        with open(self.filename, 'a') as lockfile:
+            start = self.try_reserve(lockfile, megabytes)
+            while start is None:
+                time.sleep(self.POLL_INTERVAL)
+                start = self.try_reserve(lockfile, megabytes)
+
+            try:
+                yield
+            finally:
+                fcntl.lockf(lockfile, fcntl.LOCK_UN, megabytes, start)
+
+    def try_reserve(self, lockfile, megabytes):
+        """Lock <megabytes> free bytes of <lockfile>; returns their offset,
+        or None if there is no such range at the moment.
+        """
+        for start in range(self.megabytes - megabytes + 1):
+            try:
+                fcntl.lockf(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB, megabytes, start)
+                return start
+            except IOError, ex:
+                if ex.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+
+        return None
+
+#-------------------------------------------------------------------------
+class ExifHeader(object):
+    """Reads the few EXIF tags fetchphotos needs directly from the APP1
+    segment of a JPEG file.  Only the segment headers and the APP1 segment
+    itself are read; the image data is never touched.
+    """
+
+    ORIENTATION = 0x0112
+    EXIF_IFD_POINTER = 0x8769
+    DATETIME_ORIGINAL = 36867
+    DATETIME_DIGITIZED = 36868
+    ## in IFD1, the IFD of the embedded thumbnail
+    THUMBNAIL_OFFSET = 0x0201
+    THUMBNAIL_LENGTH = 0x0202
+
+    ## the magic numbers after the byte order: TIFF (and most RAW
+    ## formats), Olympus ORF ('RO' and 'SR') and Panasonic RW2
+    MAGIC_NUMBERS = (42, 0x4f52, 0x5352, 0x55)
+
+    ## TIFF field types we can decode
+    ASCII = 2
+    SHORT = 3
+    LONG = 4
+
+    SOI = b'\xff\xd8'
+    APP1 = 0xe1
+    SOS = 0xda
+    EOI = 0xd9
+
+    @classmethod
+    def read_tags(cls, filename):
+        """Return a dictionary with the orientation and time tags found in
+        the EXIF data of <filename>, or None if there is no EXIF data.
+        """
+        with open(filename, 'rb') as image:
+            tiff = cls.find_exif(image)[1]
+
+        if tiff is None:
+            return None
+
+        return cls.parse(tiff)
+
+    @classmethod
+    def find_exif(cls, image):
+        """Return the position in the open file <image> and the content of
+        the TIFF structure in the APP1 segment, or (None, None).
+        """
+        if image.read(2) != cls.SOI:
+            return None, None
+
+        while True:
+            header = image.read(4)
+            if len(header) < 4 or header[0:1] != b'\xff':
+                return None, None
+
+            marker = ord(header[1:2])
+            length = struct.unpack('>H', header[2:4])[0]
+            if marker in (cls.SOS, cls.EOI):
+                ## the metadata segments are all in front of the image data
+                return None, None
+            elif marker == cls.APP1:
+                start = image.tell()
+                data = image.read(length - 2)
+                if data.startswith(b'Exif\x00\x00'):
+                    return start + 6, data[6:]
+            else:
+                image.seek(length - 2, os.SEEK_CUR)
+
+    @classmethod
+    def set_orientation(cls, filename, orientation):
+        """Overwrite the orientation tag of <filename> in place.
+        Returns False if the file has no orientation tag to overwrite, or
+        if the tag has that value already (then the file is not written).
+        """
+        with open(filename, 'r+b') as image:
+            start, tiff = cls.find_exif(image)
+            if tiff is None:
+                return False
+
+            byteorder = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+            if byteorder is None:
+                return False
+
+            try:
+                offset = struct.unpack_from(byteorder + 'I', tiff, 4)[0]
+                count = struct.unpack_from(byteorder + 'H', tiff, offset)[0]
+                for index in range(count):
+                    entry = offset + 2 + 12 * index
+                    tag, field_type = struct.unpack_from(byteorder + 'HH', tiff, entry)
+                    if tag == cls.ORIENTATION and field_type == cls.SHORT:
+                        if struct.unpack_from(byteorder + 'H', tiff, entry + 8)[0] == orientation:
+                            return False
+                        image.seek(start + entry + 8)
+                        image.write(struct.pack(byteorder + 'H', orientation))
+                        return True
+            except struct.error:
+                pass
+
+        return False
+
+    @classmethod
+    def parse(cls, tiff):
+        """Parse the TIFF structure <tiff> (the content of the APP1 segment
+        after the "Exif" header).
+        """
+        byteorder = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+        if byteorder is None:
+            return None
+
+        try:
+            magic, offset = struct.unpack_from(byteorder + 'HI', tiff, 2)
+            if magic not in cls.MAGIC_NUMBERS:
+                return None
+
+            tags = cls.read_ifd(tiff, offset, byteorder)
+            exif_offset = tags.pop(cls.EXIF_IFD_POINTER, None)
+            if exif_offset is not None:
+                tags.update(cls.read_ifd(tiff, exif_offset, byteorder))
+        except struct.error:
+            return None
+
+        ## the link to the thumbnail IFD is often junk (or cut off, in the
+        ## RAW headers): then there is no thumbnail, but the tags are good
+        try:
+            count = struct.unpack_from(byteorder + 'H', tiff, offset)[0]
+            thumbnail_ifd = struct.unpack_from(byteorder + 'I', tiff, offset + 2 + 12 * count)[0]
+            if thumbnail_ifd:
+                tags.update(cls.read_ifd(tiff, thumbnail_ifd, byteorder,
+                                         (cls.THUMBNAIL_OFFSET, cls.THUMBNAIL_LENGTH)))
+        except struct.error:
+            pass
+
+        return tags
+
+    @classmethod
+    def read_thumbnail(cls, filename):
+        """Return the embedded (JPEG) thumbnail of <filename>, or None."""
+        with open(filename, 'rb') as image:
+            tiff = cls.find_exif(image)[1]
+
+        if tiff is None:
+            return None
+
+        tags = cls.parse(tiff)
+        if tags is None or cls.THUMBNAIL_OFFSET not in tags or cls.THUMBNAIL_LENGTH not in tags:
+            return None
+
+        start = tags[cls.THUMBNAIL_OFFSET]
+        thumbnail = tiff[start:start + tags[cls.THUMBNAIL_LENGTH]]
+        if not thumbnail.startswith(cls.SOI):
+            return None
+
+        return thumbnail
+
+    @classmethod
+    def read_ifd(cls, tiff, offset, byteorder, wanted=None):
+        """Return the tags we are interested in from the IFD at <offset>."""
+        if wanted is None:
+            wanted = (cls.ORIENTATION, cls.EXIF_IFD_POINTER,
+                      cls.DATETIME_ORIGINAL, cls.DATETIME_DIGITIZED)
+        tags = {}
+
+        count = struct.unpack_from(byteorder + 'H', tiff, offset)[0]
+        for index in range(count):
+            entry = offset + 2 + 12 * index
+            tag, field_type, length = struct.unpack_from(byteorder + 'HHI', tiff, entry)
+            if tag not in wanted:
+                continue
+
+            if field_type == cls.SHORT:
+                tags[tag] = struct.unpack_from(byteorder + 'H', tiff, entry + 8)[0]
+            elif field_type == cls.LONG:
+                tags[tag] = struct.unpack_from(byteorder + 'I', tiff, entry + 8)[0]
+            elif field_type == cls.ASCII:
+                if length > 4:
+                    start = struct.unpack_from(byteorder + 'I', tiff, entry + 8)[0]
+                else:
+                    start = entry + 8
+                tags[tag] = tiff[start:start + length].split(b'\x00', 1)[0]
+
+        return tags
+
+#-------------------------------------------------------------------------
+class QuickTimeHeader(object):
+    """Reads the creation time from the movie header (the mvhd box) of MP4
+    and QuickTime files.  Only the box headers are read on the way; the
+    boxes in between, like the media data, are skipped by seeking.
+    """
+
+    BOX = struct.Struct('>I4s')
+
+    ## seconds from 1904-01-01 (the start of QuickTime time) to 1970-01-01
+    EPOCH_OFFSET = 2082844800
+
+    @classmethod
+    def read_creation_time(cls, filename):
+        """Return the creation time of the movie in <filename> (as local
+        time), or None.
+        """
+        with open(filename, 'rb') as movie:
+            size = os.fstat(movie.fileno()).st_size
+            try:
+                moov = cls.find_box(movie, 0, size, b'moov')
+                if moov is None:
+                    return None
+                mvhd = cls.find_box(movie, moov[0], moov[1], b'mvhd')
+                if mvhd is None:
+                    return None
+
+                movie.seek(mvhd[0])
+                version = struct.unpack('>B3x', movie.read(4))[0]
+                if version == 1:
+                    created = struct.unpack('>Q', movie.read(8))[0]
+                else:
+                    created = struct.unpack('>I', movie.read(4))[0]
+            except struct.error:
+                return None
+
+        if not created:
+            return None
+
+        ## the time is UTC (though some cameras write their local time)
+        try:
+            return datetime.fromtimestamp(created - cls.EPOCH_OFFSET)
+        except (ValueError, OverflowError):
+            return None
+
+    @classmethod
+    def find_box(cls, movie, start, end, wanted):
+        """Return the start and the end of the content of the first box of
+        type <wanted> between the offsets <start> and <end>, or None.
+        """
+        offset = start
+        while offset + cls.BOX.size <= end:
+            movie.seek(offset)
+            size, kind = cls.BOX.unpack(movie.read(cls.BOX.size))
+            header = cls.BOX.size
+            if size == 1:
+                size = struct.unpack('>Q', movie.read(8))[0]
+                header += 8
+            elif size == 0:
+                ## up to the end of the file
+                size = end - offset
+            if size < header:
+                return None
+
+            if kind == wanted:
+                return offset + header, offset + size
+            offset += size
+
+        return None
+
 #-------------------------------------------------------------------------
 class FPFileInfo(object):
-    """This class provides filesystem and EXIF data about an image file."""
+    """This class provides filesystem and EXIF data about an image file.
+    There is one for each file of a run (the removal queue may hold all of
+    them), so it only keeps the fields it needs, in slots.
+    """
+
+    __slots__ = ('logger', 'cfg', 'path', 'size', 'mtime', 'ctime', 'mode', 'device', 'inode',
+                 'moved', 'transferred', 'resumed', 'compute_digest', 'collisions',
+                 'timings', 'written', 'partial_hash', 'content_hash', 'destination_hash',
+                 'progress', 'rotation_type', 'orientation', 'new_path', 'time')
 
     FORMATSTRING = u"%Y-%m-%dT%H.%M.%S"
 
-    def __init__(self, filename, logger, config):
+    ## number of bytes used for the quick comparison of files
+    PARTIAL_HASH_SIZE = 64 * 1024
+
+    ## path of jpegtran ("" if there is none), looked up on first use
+    jpegtran = None
+
+    ## copies of files bigger than this log their progress
+    PROGRESS_SIZE = 256 * 1024 * 1024
+
+    ## start of the names of the files being written
+    TEMPORARY_PREFIX = u".fetchphotos-"
+
+    ## seconds after which a temporary file of another machine is stale
+    TEMPORARY_MAX_AGE = 24 * 60 * 60
+
+    def __init__(self, filename, logger, config, status=None):
+        """<status> is the result of os.stat(filename), if the caller has it."""
         self.logger = logger
         self.cfg = config
         self.path = filename
-        self.name = os.path.basename(filename)
-        self.ctime = datetime.fromtimestamp(os.path.getctime(filename)).replace(microsecond=0)
+        if status is None:
+            status = os.stat(filename)
+        self.size = status.st_size
+        self.mtime = status.st_mtime
+        self.ctime = status.st_ctime
+        self.mode = stat.S_IMODE(status.st_mode)
+        self.device = status.st_dev
+        self.inode = status.st_ino
+        self.moved = False
+        self.transferred = False
+        self.resumed = False
+        ## whether to hash the destination (for verifying it, and the manifest)
+        self.compute_digest = False
+        self.collisions = 0
+        self.timings = {}
+        self.written = 0
+        self.partial_hash = None
+        self.content_hash = None
+        self.destination_hash = None
+        self.progress = 0
         self.rotation_type = ""
         self.orientation = 1
         self.new_path = ''
-        self.image = None
-        self.time = self.ctime
+        ## set by initialize_exifdata
+        self.time = None
+
+    def __getstate__(self):
+        """Allows FPFileInfo objects to be passed to worker processes.
+        The logger is replaced by its name.
+        """
+        state = dict((name, getattr(self, name)) for name in FPFileInfo.__slots__)
+        state['logger'] = self.logger.name
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+        self.logger = logging.getLogger(state['logger'])
+
+    def get_file_time(self):
+        """Return the creation time of the file (without microseconds)."""
+        return datetime.fromtimestamp(self.ctime).replace(microsecond=0)
 
     def initialize_exifdata(self):
         """Gets the data we need from exif, with defaults"""
-        self.image = Image.open(self.path)
-        exiftags = self.image._getexif()
+        exiftags = self.read_exif_tags()
         if exiftags is not None:
             self.logger.debug(u"current image is an jpeg image with EXIF data")
             self.orientation = self.get_jpeg_orientation(exiftags)
             self.time = self.get_exif_creation_time(exiftags)
         else:
             self.orientation = 1
-            self.time = self.ctime
+            self.time = self.get_file_time()
 
         self.set_new_filename()
 
+    def read_exif_tags(self):
+        """Return the EXIF tags of the file, or None"""
+        return ExifHeader.read_tags(self.path)
+
     def get_exif_creation_time(self, exiftags):
         """Extract the image creation time from the EXIF metadata, if possible."""
 
         exif_time = exiftags.get(36868, 'no_time')
         if exif_time == 'no_time':
             exif_time = exiftags.get(36867, 'no_time')
+        if exif_time == 'no_time':
+            self.logger.debug(u"no time in EXIF data, using the file creation time")
+            return self.get_file_time()
 
         creation_time = datetime.strptime(exif_time, "%Y:%m:%d %H:%M:%S")
         self.logger.debug(u"exif_time is %s, creation_time is %s",
@@ -292,22 +1603,74 @@ class FPFileInfo(object):
     def get_orientation(self):
         return self.orientation
 
+    @staticmethod
+    def hash_file(filename, limit=None):
+        """Return the SHA-1 hash of the content of <filename>, or of its
+        first <limit> bytes.
+        """
+        digest = hashlib.sha1()
+        with open(filename, 'rb') as source:
+            if limit is not None:
+                digest.update(source.read(limit))
+            else:
+                for block in iter(lambda: source.read(1024 * 1024), b''):
+                    digest.update(block)
+
+        return digest.hexdigest()
+
+    def get_content_filename(self):
+        """Return the name under which the content of the source is: once
+        the source was moved (see transfer_file), that is the destination.
+        """
+        if self.moved:
+            return self.get_new_filename()
+        return self.path
+
+    def get_partial_hash(self):
+        """Return the hash of the start of the file (calculated on first use)."""
+        if self.partial_hash is None:
+            self.partial_hash = self.hash_file(self.get_content_filename(), self.PARTIAL_HASH_SIZE)
+
+        return self.partial_hash
+
+    def get_content_hash(self):
+        """Return the hash of the file content (calculated on first use)."""
+        if self.content_hash is None:
+            self.content_hash = self.hash_file(self.get_content_filename())
+
+        return self.content_hash
+
     def get_timestamp(self):
         return time.strftime(self.FORMATSTRING, self.time)
 
     def set_new_filename(self):
         """Calculates the path for the destination file."""
         if self.cfg.getboolean('File_processing', 'LOWERCASE_FILENAME'):
-            filen = self.name.lower()
+            filen = os.path.basename(self.path).lower()
         else:
-            filen = self.name
+            filen = os.path.basename(self.path)
 
         new_filename = self.time.isoformat().replace(':', '.') + "_" + filen
 
+        layout = self.cfg.get_destination_layout()
+        if layout:
+            new_filename = os.path.join(self.time.strftime(layout), new_filename)
+
         self.new_path = os.path.join(
             self.cfg.get_destdir(),
             new_filename)
 
+    def set_collision_suffix(self, count):
+        """Recalculates the destination path, with "_<count>" added in
+        front of the extension to tell it apart from an earlier file with
+        the same name.
+        """
+        self.set_new_filename()
+        self.collisions = count
+        if count:
+            base, ext = os.path.splitext(self.new_path)
+            self.new_path = u"{}_{}{}".format(base, count, ext)
+
     def get_new_filename(self):
         """Returns path of new image file"""
         return self.new_path
@@ -318,29 +1681,569 @@ class FPFileInfo(object):
         self.logger.debug(u"rotate_picture_according_exif called with file %s", self.path)
 
         self.rotation_type = ""
-        new_filename = self.get_new_filename()
-
-        if self.orientation == 1:
-            shutil.copy(self.path, new_filename)
-        elif self.orientation == 6:
-            self.rotation_type = u" (rotated 90° ccw)"
-            self.image.rotate(-90, expand=True).save(new_filename)
-        elif self.orientation == 8:
-            self.rotation_type = u" (rotated 90° cw)"
-            self.image.rotate(90, expand=True).save(new_filename)
+        new_filename = self.get_temporary_filename()
+        mode = self.cfg.get_rotation_mode()
+
+        try:
+            if mode == u'metadata':
+                self.transfer_file(new_filename)
+                ## the viewers honor all valid values (mirrored and upside
+                ## down, too); only invalid ones are reset to normal
+                tags = ExifHeader.read_tags(new_filename) or {}
+                if not 1 <= tags.get(ExifHeader.ORIENTATION, 1) <= 8 and \
+                   ExifHeader.set_orientation(new_filename, 1):
+                    self.rotation_type = u" (orientation tag set to 1)"
+            elif self.orientation == 1 or mode == u'none':
+                self.transfer_file(new_filename)
+            elif self.orientation == 6:
+                self.rotation_type = u" (rotated 90° ccw)"
+                self.rotate_picture(-90, new_filename)
+            elif self.orientation == 8:
+                self.rotation_type = u" (rotated 90° cw)"
+                self.rotate_picture(90, new_filename)
+            else:
+                self.logger.warn(u"Found unknown/unhandled orientation %s -- " +
+                                 u"orientation not changed", self.orientation)
+                self.transfer_file(new_filename)
+
+            self.commit_destination(new_filename)
+        except BaseException:
+            self.discard_temporary_file(new_filename)
+            raise
+
+    def get_temporary_filename(self):
+        """Create an empty, hidden file next to the destination, to write
+        the new file into; it gets its final name in commit_destination.
+        The extension stays the same, PIL chooses the format by it.  The
+        name contains the process ID and the host name, see
+        is_stale_temporary_file.
+        """
+        import socket
+
+        directory, name = os.path.split(self.get_new_filename())
+        descriptor, temporary = tempfile.mkstemp(
+            prefix=u"{}{}+{}+{}.".format(self.TEMPORARY_PREFIX, os.getpid(),
+                                         socket.gethostname(), name),
+            suffix=os.path.splitext(name)[1],
+            dir=directory)
+        os.close(descriptor)
+        return temporary
+
+    @classmethod
+    def is_stale_temporary_file(cls, directory, name):
+        """Return True if <name> in <directory> is a temporary file which
+        was left by an interrupted run: on this machine, if its process is
+        not running any more.  A file from another machine (which shares the
+        directory) can't be checked like that; it is only stale when it was
+        not written for TEMPORARY_MAX_AGE seconds.
+        """
+        import socket
+
+        if not name.startswith(cls.TEMPORARY_PREFIX):
+            return False
+
+        ## <pid>+<host name>+<destination name>...; host names have no "+"
+        pid, dummy, rest = name[len(cls.TEMPORARY_PREFIX):].partition(u'+')
+        host, separator, dummy = rest.partition(u'+')
+        if pid.isdigit() and separator and host == socket.gethostname():
+            try:
+                os.kill(int(pid), 0)
+            except OSError, ex:
+                ## EPERM: the process exists, but belongs to someone else
+                return ex.errno != errno.EPERM
+            return False
+
+        try:
+            return time.time() - os.path.getmtime(os.path.join(directory, name)) > \
+                cls.TEMPORARY_MAX_AGE
+        except OSError:
+            return False
+
+    def discard_temporary_file(self, temporary):
+        """Clean up after a failed transfer: a moved source is moved back,
+        anything else is removed.
+        """
+        if self.moved:
+            os.rename(temporary, self.path)
+            self.moved = False
+        elif os.path.exists(temporary):
+            os.remove(temporary)
+
+    def commit_destination(self, temporary):
+        """Write <temporary> to disk and give it the destination name in one
+        step, so there never is a partial file under that name.  If another
+        process took the name in the meantime, the file gets the next free
+        collision suffix instead (or is dropped, if the other file has the
+        same content).
+        """
+        if not self.moved:
+            os.chmod(temporary, self.mode)
+        if self.compute_digest:
+            if not self.rotation_type and self.content_hash is not None:
+                ## unchanged, and hashed while copying
+                self.destination_hash = self.content_hash
+            else:
+                ## just written, this comes from the page cache
+                self.destination_hash = self.hash_file(temporary)
+        FileCopier.sync(temporary)
+
+        while True:
+            new_filename = self.get_new_filename()
+            try:
+                ## unlike rename(), link() never replaces an existing file
+                os.link(temporary, new_filename)
+            except OSError, ex:
+                if ex.errno == errno.EEXIST:
+                    if self.same_content(temporary, new_filename):
+                        self.logger.info(u"%s exists already with the same content", new_filename)
+                        break
+                    self.set_collision_suffix(self.collisions + 1)
+                    self.logger.warning(u"destination name for %s already taken, trying %s",
+                                        self.path, self.get_new_filename())
+                    continue
+                if ex.errno not in (errno.EPERM, errno.EOPNOTSUPP, errno.EMLINK, errno.ENOSYS):
+                    raise
+                ## no hard links here (like FAT): rename after checking
+                if os.path.lexists(new_filename):
+                    if self.same_content(temporary, new_filename):
+                        self.logger.info(u"%s exists already with the same content", new_filename)
+                        break
+                    self.set_collision_suffix(self.collisions + 1)
+                    continue
+                os.rename(temporary, new_filename)
+                return
+            break
+
+        os.remove(temporary)
+
+    def has_same_content(self, filename):
+        """Return True if <filename> exists and has the content of the
+        source.  Its size is compared first.
+        """
+        try:
+            if not stat.S_ISREG(os.lstat(filename).st_mode) or \
+               os.path.getsize(filename) != self.size:
+                return False
+        except OSError:
+            return False
+        return self.hash_file(filename) == self.get_content_hash()
+
+    @staticmethod
+    def same_content(first, second):
+        """Return True if the files <first> and <second> are identical."""
+        if os.path.getsize(first) != os.path.getsize(second):
+            return False
+        return FPFileInfo.hash_file(first) == FPFileInfo.hash_file(second)
+
+    def transfer_file(self, new_filename):
+        """Copy the file unchanged to <new_filename>.  If the source is not
+        kept, and both are on the same file system, it is renamed instead.
+        """
+        if not self.cfg.getboolean('File_processing', 'KEEP_ORIGINALS'):
+            destdir = os.path.dirname(os.path.abspath(new_filename))
+            if os.stat(destdir).st_dev == self.device:
+                os.rename(self.path, new_filename)
+                self.moved = True
+                self.transferred = True
+                return
+
+        if self.size > self.PROGRESS_SIZE:
+            progress = self.report_progress
         else:
-            self.logger.warn(u"Found unknown/unhandled orientation %s -- " +
-                             u"orientation not changed", self.orientation)
-            shutil.copy(self.path, new_filename)
+            progress = None
+
+        if self.compute_digest:
+            digest = hashlib.sha1()
+            FileCopier.copy(self.path, new_filename, digest, progress)
+            self.content_hash = digest.hexdigest()
+        else:
+            FileCopier.copy(self.path, new_filename, progress=progress)
+        self.transferred = True
+
+    def report_progress(self, copied, size):
+        """Log the progress of a long copy, every ten percent."""
+        percent = 100 * copied // max(size, 1)
+        if percent // 10 > self.progress // 10:
+            self.logger.info(u"%s: %d%% copied (%d of %d MB)", self.path, percent,
+                             copied >> 20, size >> 20)
+        self.progress = percent
+
+    def verify_destination(self, paranoid=False):
+        """Return True if the destination has the size it was written with
+        (and, if the file was transferred unchanged, the size of the source).
+        If <paranoid>, the destination is also read back from the disk, and
+        its hash compared with the one calculated while writing it.
+        """
+        try:
+            size = os.path.getsize(self.get_new_filename())
+        except OSError:
+            return False
+
+        if size != self.written or (self.transferred and size != self.size):
+            return False
+
+        if paranoid and self.destination_hash is not None:
+            FileCopier.drop_cache(self.get_new_filename())
+            return self.hash_file(self.get_new_filename()) == self.destination_hash
+        return True
+
+    def rotate_picture(self, angle, new_filename):
+        """Save the image rotated by <angle> degrees (counterclockwise).
+        Unless LOSSLESS_ROTATION is false, jpegtran is tried first; it
+        rotates the compressed data without decoding the image.
+        Both ways need memory for two copies of the image, which is
+        reserved from the DECODE_MEMORY_MB budget first.
+        """
+        from PIL import Image
+
+        mode = self.cfg.get('File_processing', 'LOSSLESS_ROTATION').lower()
+
+        ## opening only reads the header
+        image = Image.open(self.path)
+        try:
+            width, height = image.size
+            megabytes = (width * height * len(image.getbands()) * 2 >> 20) + 1
+            budget = DecodeBudget(self.cfg.getint('File_processing', 'DECODE_MEMORY_MB'))
+            with budget.reserve(megabytes):
+                if mode in (u'perfect', u'trim') and \
+                   self.rotate_losslessly(angle, new_filename, mode):
+                    return
+
+                self.logger.debug(u"rotating %s with PIL", self.path)
+                if angle == 90:
+                    rotated = image.transpose(Image.ROTATE_90)
+                else:
+                    rotated = image.transpose(Image.ROTATE_270)
+                image.close()
+                try:
+                    rotated.save(new_filename)
+                finally:
+                    rotated.close()
+        finally:
+            image.close()
+
+    def rotate_losslessly(self, angle, new_filename, mode):
+        """Rotate the image with jpegtran, keeping all metadata.  The EXIF
+        orientation of the result is set to 1 (normal).
+        With <mode> 'perfect', images whose size is not a multiple of the
+        block size are not rotated here; with 'trim', their partial edge
+        blocks are dropped.  Returns False if the caller should fall back
+        to PIL.
+        """
+        from distutils.spawn import find_executable
+        import subprocess
+
+        if FPFileInfo.jpegtran is None:
+            FPFileInfo.jpegtran = find_executable(u"jpegtran") or u""
+        if not FPFileInfo.jpegtran:
+            self.logger.debug(u"jpegtran not found, can't rotate losslessly")
+            return False
+
+        try:
+            subprocess.check_output([FPFileInfo.jpegtran, u"-copy", u"all",
+                                     u"-" + mode, u"-rotate", unicode((-angle) % 360),
+                                     u"-outfile", new_filename, self.path],
+                                    stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError, ex:
+            self.logger.debug(u"jpegtran could not rotate %s: %s", self.path, ex.output)
+            if os.path.exists(new_filename):
+                os.remove(new_filename)
+            return False
+
+        ExifHeader.set_orientation(new_filename, 1)
+        self.rotation_type += u" (lossless)"
+        return True
+
+    def write_thumbnails(self):
+        """Write the THUMBNAIL_SIZES previews of the image, upright, into
+        THUMBNAIL_DIR/<size>/.  If the thumbnail embedded in the EXIF data
+        is big enough, that is used.  Otherwise the image is decoded once, at
+        the smallest JPEG scale (draft mode) that is big enough for the
+        largest size, and scaled down from size to size.
+        """
+        sizes = self.cfg.get_thumbnail_sizes()
+        if not sizes:
+            return
+
+        from PIL import Image
+
+        source = self.get_content_filename()
+
+        image = None
+        embedded = ExifHeader.read_thumbnail(source)
+        if embedded is not None:
+            image = Image.open(io.BytesIO(embedded))
+            if max(image.size) < sizes[0]:
+                image = None
+
+        if image is None:
+            image = Image.open(source)
+            image.draft('RGB', (sizes[0], sizes[0]))
+
+        try:
+            width, height = image.size
+            budget = DecodeBudget(self.cfg.getint('File_processing', 'DECODE_MEMORY_MB'))
+            with budget.reserve((width * height * 3 * 2 >> 20) + 1):
+                image.load()
+                if self.orientation == 6:
+                    image = image.transpose(Image.ROTATE_270)
+                elif self.orientation == 8:
+                    image = image.transpose(Image.ROTATE_90)
+                if image.mode != 'RGB':
+                    image = image.convert('RGB')
+
+                relative = os.path.relpath(self.get_new_filename(), self.cfg.get_destdir())
+                for size in sizes:
+                    image.thumbnail((size, size), Image.ANTIALIAS)
+                    thumbnail = os.path.join(self.cfg.get_thumbnail_dir(), unicode(size), relative)
+                    if not os.path.isdir(os.path.dirname(thumbnail)):
+                        try:
+                            os.makedirs(os.path.dirname(thumbnail))
+                        except OSError, ex:
+                            if ex.errno != errno.EEXIST:
+                                raise
+                    image.save(thumbnail, 'JPEG', quality=85)
+        finally:
+            image.close()
 
     def remove_source_file(self):
-        """Removes the souce image file."""
-        os.remove(self.path)
+        """Removes the souce image file (unless it was moved already)."""
+        if not self.moved:
+            os.remove(self.path)
         self.path = None
 
     def get_rotation_type(self):
         return self.rotation_type
 
+class FPRawFileInfo(FPFileInfo):
+    """A camera RAW file.  These are TIFF files, so the EXIF data is read
+    from the start of the file.  RAW files are never rotated; raw converters
+    use their orientation tag.
+    """
+
+    __slots__ = ()
+
+    ## number of bytes to read for the EXIF data
+    HEADER_SIZE = 256 * 1024
+
+    def read_exif_tags(self):
+        with open(self.path, 'rb') as raw:
+            return ExifHeader.parse(raw.read(self.HEADER_SIZE))
+
+    def rotate_and_copy_picture(self):
+        self.rotation_type = ""
+        new_filename = self.get_temporary_filename()
+        try:
+            self.transfer_file(new_filename)
+            self.commit_destination(new_filename)
+        except BaseException:
+            self.discard_temporary_file(new_filename)
+            raise
+
+    def write_thumbnails(self):
+        pass
+
+class FPPlainFileInfo(FPRawFileInfo):
+    """A file whose metadata fetchphotos can't read (HEIC images, AVI
+    videos).  It is copied unchanged, and named after its creation time.
+    """
+
+    __slots__ = ()
+
+    def read_exif_tags(self):
+        return None
+
+class FPVideoFileInfo(FPPlainFileInfo):
+    """An MP4 or QuickTime video.  It is named after the creation time in
+    its movie header, and copied unchanged, chunk by chunk.
+    """
+
+    __slots__ = ()
+
+    def initialize_exifdata(self):
+        self.orientation = 1
+        self.time = QuickTimeHeader.read_creation_time(self.path)
+        if self.time is None:
+            self.logger.debug(u"no time in the movie header, using the file creation time")
+            self.time = self.get_file_time()
+
+        self.set_new_filename()
+
+## The kinds of files fetchphotos knows, by extension.  Which of them are
+## fetched is set by IMAGE_EXTENSIONS and VIDEO_EXTENSIONS; other
+## extensions given there are handled by FPPlainFileInfo.
+FILE_HANDLERS = {
+    u'jpg': FPFileInfo,
+    u'jpeg': FPFileInfo,
+    u'arw': FPRawFileInfo,
+    u'cr2': FPRawFileInfo,
+    u'dng': FPRawFileInfo,
+    u'nef': FPRawFileInfo,
+    u'orf': FPRawFileInfo,
+    u'pef': FPRawFileInfo,
+    u'rw2': FPRawFileInfo,
+    u'heic': FPPlainFileInfo,
+    u'avi': FPPlainFileInfo,
+    u'm4v': FPVideoFileInfo,
+    u'mov': FPVideoFileInfo,
+    u'mp4': FPVideoFileInfo,
+}
+
+def _initialize_fileinfo(fpfile):
+    """Worker function: read the EXIF data of <fpfile> (unless it came
+    from the metadata cache)
+    """
+    if fpfile.resumed or fpfile.time is not None:
+        return fpfile
+    start = time.time()
+    fpfile.initialize_exifdata()
+    fpfile.timings[u'metadata'] = time.time() - start
+    return fpfile
+
+def _transform_fileinfo(fpfile):
+    """Worker function: rotate and copy <fpfile> to its destination"""
+    if fpfile.resumed:
+        return fpfile
+    start = time.time()
+    fpfile.rotate_and_copy_picture()
+    fpfile.timings[u'transform'] = time.time() - start
+    fpfile.written = os.path.getsize(fpfile.get_new_filename())
+
+    start = time.time()
+    fpfile.write_thumbnails()
+    fpfile.timings[u'thumbnails'] = time.time() - start
+    return fpfile
+
+#-------------------------------------------------------------------------
+class Manifest(object):
+    """The list of the files written by a run, with their SHA-1 hashes, in
+    the format of sha1sum: "sha1sum -c <manifest>" in DESTINATIONDIR checks
+    them.  The file is created with the first entry.
+    """
+
+    def __init__(self, filename, destdir):
+        self.filename = filename
+        self.destdir = destdir
+        self.out = None
+
+    def add(self, fpfile):
+        """Add the destination of <fpfile> (if it was hashed)."""
+        if fpfile.destination_hash is None:
+            return
+
+        if self.out is None:
+            if not os.path.isdir(os.path.dirname(self.filename)):
+                os.makedirs(os.path.dirname(self.filename))
+            self.out = io.open(self.filename, 'a', encoding='utf-8')
+
+        self.out.write(u"{}  {}\n".format(fpfile.destination_hash,
+                                          os.path.relpath(fpfile.get_new_filename(), self.destdir)))
+
+    def close(self):
+        """Close the manifest."""
+        if self.out is not None:
+            self.out.close()
+
+#-------------------------------------------------------------------------
+class Profiler(object):
+    """Collects the time spent in each stage of the ingest, and the number
+    of bytes read and written, for the --profile report.  With a trace file,
+    a JSON object per file (and one with the totals) is appended to it.
+    """
+
+    STAGES = (u'discovery', u'metadata', u'transform', u'thumbnails', u'remove')
+
+    def __init__(self, trace_filename=None):
+        self.start = time.time()
+        self.durations = collections.defaultdict(list)
+        self.files = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+        self.trace = None
+        if trace_filename:
+            self.trace = open(trace_filename, 'a')
+
+    def timed(self, stage, iterable):
+        """Pass on the items of <iterable>, timing how long each takes."""
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.durations[stage].append(time.time() - start)
+            yield item
+
+    def add_file(self, fpfile, source):
+        """Add the timings of <fpfile> (whose source was <source>)."""
+        self.files += 1
+        for stage, seconds in fpfile.timings.iteritems():
+            self.durations[stage].append(seconds)
+        if u'transform' in fpfile.timings:
+            self.bytes_read += fpfile.size
+            self.bytes_written += fpfile.written
+
+        if self.trace is not None:
+            record = {u'file': source,
+                      u'destination': fpfile.get_new_filename(),
+                      u'size': fpfile.size,
+                      u'written': fpfile.written}
+            record.update(fpfile.timings)
+            self.trace.write(json.dumps(record) + '\n')
+
+    def add_duration(self, stage, seconds):
+        """Add a duration which does not belong to a single file (like the
+        removal of a batch of files).
+        """
+        self.durations[stage].append(seconds)
+
+    @staticmethod
+    def percentile(values, fraction):
+        """Return the <fraction> percentile of <values> (nearest rank)."""
+        ordered = sorted(values)
+        return ordered[max(0, int(math.ceil(fraction * len(ordered))) - 1)]
+
+    def get_elapsed(self):
+        """Return the seconds since the start."""
+        return max(time.time() - self.start, 1e-6)
+
+    def report(self):
+        """Print the summary."""
+        elapsed = self.get_elapsed()
+
+        print u"{:<10} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+            u"stage", u"count", u"total s", u"p50 ms", u"p95 ms", u"p99 ms")
+        for stage in self.STAGES:
+            values = self.durations.get(stage)
+            if not values:
+                continue
+            print u"{:<10} {:>7} {:>9.2f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+                stage, len(values), sum(values),
+                1000 * self.percentile(values, 0.50),
+                1000 * self.percentile(values, 0.95),
+                1000 * self.percentile(values, 0.99))
+
+        megabyte = 1024.0 * 1024.0
+        print (u"read {:.1f} MB ({:.1f} MB/s), written {:.1f} MB ({:.1f} MB/s), " +
+               u"{} files in {:.2f} s ({:.1f} files/s)").format(
+                   self.bytes_read / megabyte, self.bytes_read / megabyte / elapsed,
+                   self.bytes_written / megabyte, self.bytes_written / megabyte / elapsed,
+                   self.files, elapsed, self.files / elapsed)
+
+    def close(self):
+        """Write the totals to the trace file, and close it."""
+        if self.trace is not None:
+            self.trace.write(json.dumps({u'summary': {
+                u'files': self.files,
+                u'elapsed': self.get_elapsed(),
+                u'read': self.bytes_read,
+                u'written': self.bytes_written,
+                u'stages': dict((stage, sum(values))
+                                for stage, values in self.durations.iteritems())}}) + '\n')
+            self.trace.close()
+
 #-------------------------------------------------------------------------
 class Fetchphotos(object):
     """This class encapsulates the functionality of the fetchphotos application"""
@@ -352,6 +2255,7 @@ class Fetchphotos(object):
     INVOCATION_TIME = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
 
     LOGGER_NAME = u"fetchphotos"
+
     EPILOG = u"\n\
     :copyright:  (c) 2015 and following by Karl Voit <tools@Karl-Voit.at>\n\
     contributions from sesamemucho https://tinyurl.com/nokhs6x\n\
@@ -363,12 +2267,34 @@ class Fetchphotos(object):
     def __init__(self, argv):
         self.argv = argv
         self.parse_args(argv)
+        self.claimed_destinations = set()
+        self.existing_directories = set()
+        self.pool = None
+        self.jobs = 1
+        self.window = 1
+        self.index = None
+        self.destination_index = None
+        self.journal = None
+        self.manifest = None
+        self.metadata_cache = None
+        self.readahead = None
+        self.profiler = None
+        self.skipped = 0
+        self.duplicates = 0
+        self.handlers = {}
+        self.walked_directories = []
+        self.failed_directories = set()
+        self.fetched_files = set()
+        self.removals = []
+        self.removed = 0
+        self.removal_time = 0.0
 
         self.logger = self.initialize_logging()
 
         self.cfg = FetchphotosConfig(self.logger,
                                      self.args.configfile,
-                                     self.args.generate_configfile)
+                                     self.args.generate_configfile,
+                                     self.args.watch)
 
     def parse_args(self, argv):
         """Handle the command line parsing."""
@@ -403,6 +2329,24 @@ class Fetchphotos(object):
                             help=("Enable dryrun mode: just simulate what would happen, " +
                                   "do not modify files or directories"))
 
+        parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=1,
+                            help=("Number of worker processes for reading and " +
+                                  "rotating/copying the files (0: one per CPU)"))
+
+        parser.add_argument("--paranoid", dest="paranoid", action="store_true",
+                            help=("Read each written file back from the disk, and compare " +
+                                  "it with what was written"))
+
+        parser.add_argument("--profile", dest="profile", action="store_true",
+                            help="Print how much time the stages of the ingest took")
+
+        parser.add_argument("--trace", dest="trace", metavar="FILE",
+                            help="Append the timings of each file as JSON lines to FILE")
+
+        parser.add_argument("-w", "--watch", dest="watch", action="store_true",
+                            help=("Keep running, and fetch new files as soon as they " +
+                                  "appear in DIGICAMDIR (e.g. when a card is mounted)"))
+
         parser.add_argument("--debug", dest="debug",
                             action="store_true",
                             help=("Enable developer debug mode -- " +
@@ -419,6 +2363,12 @@ class Fetchphotos(object):
         if args.verbose and args.quiet:
             parser.error("please use either verbose (--verbose) or quiet (-q) option")
 
+        if args.jobs < 0:
+            parser.error("the number of jobs (--jobs) must not be negative")
+
+        if args.watch and args.filelist:
+            parser.error("--watch fetches from DIGICAMDIR, it can't be used with file names")
+
         self.args = args
 
     def initialize_logging(self):
@@ -470,29 +2420,82 @@ class Fetchphotos(object):
 
         return logger
 
-    def get_filenames_to_process(self):
-        """Get a list of the files that should be copied.
-        If these names were passed in on the command line, use
-        those. Otherwise, look for files in DIGICAMDIR.
+    def get_files_to_process(self, directories=None):
+        """Generate the files that should be copied, as tuples of file name,
+        os.stat() result and FPFileInfo class.  If these names were passed
+        in on the command line, use those. Otherwise, look for files in
+        <directories> (by default DIGICAMDIR) and their subdirectories.
         """
+        self.handlers = dict((extension, FILE_HANDLERS.get(extension, FPPlainFileInfo))
+                             for extension in self.cfg.get_extensions())
+
         if self.args.filelist:
             self.logger.debug("Setting files to %s", self.args.filelist)
-            files = self.args.filelist
+            for filename in self.args.filelist:
+                try:
+                    status = os.stat(filename)
+                except OSError:
+                    self.logger.warning(u"%s does not exist, skipping", filename)
+                    continue
+
+                # Make sure we return only files, not directories
+                if stat.S_ISREG(status.st_mode):
+                    yield filename, status, self.get_handler(filename) or FPFileInfo
         else:
-            # Look for all .jpg files in the source directory
-            # The '.jpg' search is not case sensitive
-            files = [os.path.join(self.cfg.get_sourcedir(), fname)
-                     for fname in sorted(
-                             [n for n in os.listdir(self.cfg.get_sourcedir()) if re.search(r'\.jpg$', n, flags=re.I)]
-                     )
-            ]
-
-            self.logger.debug("Checking files in %s, got %s",
-                              self.cfg.get_sourcedir(),
-                              files)
-
-        # Make sure we return only files, not directories
-        return itertools.ifilter(os.path.isfile, files)
+            for directory in directories or [self.cfg.get_sourcedir()]:
+                self.logger.debug("Checking files in %s", directory)
+                for item in self.scan_directory(directory):
+                    yield item
+
+    def get_handler(self, filename):
+        """Return the FPFileInfo class for <filename>, or None if files with
+        its extension are not fetched.
+        """
+        return self.handlers.get(os.path.splitext(filename)[1][1:].lower())
+
+    def scan_directory(self, directory):
+        """Generate the files in <directory> and its subdirectories (in the
+        order of their names) that have a handler, see get_files_to_process.
+        Each entry is stat()ed at most once, and only when it is its turn.
+        With SKIP_FETCHED_DIRECTORIES, the files of directories that were
+        completely fetched before, and did not change since, are skipped.
+        Their subdirectories are searched all the same: a new file only
+        changes the directory it is in.
+        """
+        if scandir is not None:
+            entries = sorted(scandir(directory), key=lambda entry: entry.name)
+        else:
+            entries = sorted(os.listdir(directory))
+
+        skip_files = False
+        if self.cfg.getboolean(u'General', u'SKIP_FETCHED_DIRECTORIES') and self.index is not None:
+            mtime = os.stat(directory).st_mtime
+            if self.index.is_imported_directory(directory, mtime, len(entries)):
+                self.logger.debug(u"%s was fetched before, skipping its files", directory)
+                skip_files = True
+            else:
+                self.walked_directories.append((directory, mtime, len(entries)))
+
+        for entry in entries:
+            if scandir is not None:
+                if entry.is_dir():
+                    for item in self.scan_directory(entry.path):
+                        yield item
+                elif not skip_files and self.get_handler(entry.name) is not None and entry.is_file():
+                    yield entry.path, entry.stat(), self.get_handler(entry.name)
+            else:
+                filename = os.path.join(directory, entry)
+                if skip_files:
+                    if os.path.isdir(filename):
+                        for item in self.scan_directory(filename):
+                            yield item
+                    continue
+                status = os.stat(filename)
+                if stat.S_ISDIR(status.st_mode):
+                    for item in self.scan_directory(filename):
+                        yield item
+                elif self.get_handler(entry) is not None and stat.S_ISREG(status.st_mode):
+                    yield filename, status, self.get_handler(entry)
 
     def main(self):
         """Main function [make pylint happy :)]"""
@@ -503,31 +2506,441 @@ class Fetchphotos(object):
         #print("Config is:")
         #config.write(sys.stdout)
 
-        self.logger.debug("filelist: [%s]", [f for f in self.get_filenames_to_process()])
-
         ## FIXXME: notify user of download time
 
-        for filename in self.get_filenames_to_process():
-            self.logger.debug("----> is file: %s", filename)
-
-            fpfile = FPFileInfo(filename, self.logger, self.cfg)
-            fpfile.initialize_exifdata()
+        self.jobs = self.args.jobs
+        if self.jobs == 0:
+            import multiprocessing
+            self.jobs = multiprocessing.cpu_count()
+        self.window = 2 * self.jobs
+
+        if self.cfg.getboolean(u'General', u'SKIP_FETCHED'):
+            self.index = IngestIndex(self.cfg.get_index_filename(), self.logger,
+                                     self.cfg.getboolean(u'General', u'INDEX_HASH'))
+
+        if self.args.profile or self.args.trace:
+            self.profiler = Profiler(self.args.trace)
+
+        if self.cfg.getboolean(u'File_processing', u'MANIFEST') and not self.args.dryrun:
+            self.manifest = Manifest(
+                os.path.join(self.cfg.get_destdir(), u'.manifests',
+                             u'fetchphotos-{}.sha1'.format(self.INVOCATION_TIME.replace(u':', u'.'))),
+                self.cfg.get_destdir())
+
+        ## a run without new files (like an empty card, or one whose files
+        ## were all fetched before) ends here, before the other indexes are
+        ## loaded and the worker processes are started
+        fpfiles = None
+        if not self.args.watch:
+            fpfiles = self.discover()
+            first = next(fpfiles, None)
+            if first is None:
+                self.logger.info(u"no files to fetch")
+                if self.index is not None:
+                    if not self.args.dryrun:
+                        self.add_walked_directories()
+                    self.index.close()
+                if self.profiler is not None:
+                    self.profiler.close()
+                if self.skipped:
+                    self.logger.info(u"skipped %d files which were fetched before", self.skipped)
+                return
+            fpfiles = itertools.chain([first], fpfiles)
+
+        if self.cfg.getboolean(u'General', u'SKIP_DUPLICATES'):
+            self.destination_index = DestinationIndex(self.cfg.get_index_filename(),
+                                                      self.cfg.get_destdir(),
+                                                      self.logger)
+
+        if self.cfg.getboolean(u'General', u'JOURNAL') and not self.args.dryrun:
+            self.journal = self.open_optional_index(IngestJournal)
+        if self.cfg.getint(u'General', u'METADATA_CACHE_SIZE') > 0:
+            self.metadata_cache = self.open_optional_index(
+                MetadataCache, self.cfg.getint(u'General', u'METADATA_CACHE_SIZE'))
 
-            if self.args.dryrun:
-                self.logger.info(u"dryrun: not processing picture")
+        try:
+            if self.args.watch:
+                self.watch()
             else:
-                fpfile.rotate_and_copy_picture()
+                self.fetch(fpfiles=fpfiles)
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+            if self.index is not None:
+                self.index.close()
+            if self.destination_index is not None:
+                self.destination_index.close()
+            if self.journal is not None:
+                self.journal.close()
+            if self.manifest is not None:
+                self.manifest.close()
+            if self.metadata_cache is not None:
+                self.metadata_cache.close()
+
+        if self.profiler is not None:
+            if self.args.profile:
+                self.profiler.report()
+            self.profiler.close()
+
+        if self.removed:
+            self.logger.info(u"removed %d files from %s in %.1f s",
+                             self.removed, self.cfg.get_sourcedir(), self.removal_time)
+        if self.skipped:
+            self.logger.info(u"skipped %d files which were fetched before", self.skipped)
+        if self.duplicates:
+            self.logger.info(u"skipped %d files which are already in %s",
+                             self.duplicates, self.cfg.get_destdir())
+
+    def open_optional_index(self, index_class, *args):
+        """Return an <index_class> object in INDEX_FILE, for an index which
+        only saves work.  If it can't be opened (like when the directory of
+        INDEX_FILE is not writable), the run goes on without it.
+        """
+        import sqlite3
 
-            self.logger.info("%s  -->  %s%s",
-                             filename,
-                             fpfile.get_new_filename(),
-                             fpfile.get_rotation_type())
+        try:
+            return index_class(self.cfg.get_index_filename(), self.logger, *args)
+        except sqlite3.Error, ex:
+            self.logger.warning(u"can't open %s in %s (%s), continuing without it",
+                                index_class.__name__, self.cfg.get_index_filename(), ex)
+            return None
+
+    def watch(self):
+        """Fetch the files in DIGICAMDIR, and then the new files whenever
+        they appear, until interrupted.  The worker processes and the indexes
+        stay open in between.
+        """
+        watcher = SourceWatcher(self.logger, self.cfg.get_sourcedir())
+        directories = None
+        try:
+            while True:
+                if os.path.isdir(self.cfg.get_sourcedir()):
+                    try:
+                        self.fetch(directories)
+                    except (IOError, OSError), ex:
+                        ## like a card pulled in the middle of a run: the
+                        ## journal knows what was done, the next pass goes on
+                        self.logger.error(u"could not fetch the files in %s: %s",
+                                          self.cfg.get_sourcedir(), ex)
+                        self.removals = []
+                self.logger.info(u"waiting for new files in %s", self.cfg.get_sourcedir())
+                directories = watcher.wait()
+        finally:
+            watcher.close()
+
+    def discover(self, directories=None):
+        """Generate the FPFileInfo objects for the files in <directories>
+        (see get_files_to_process) which were not fetched before.
+        """
+        self.walked_directories = []
+        self.failed_directories = set()
+
+        fpfiles = (self.new_fileinfo(filename, status, handler)
+                   for filename, status, handler in self.get_files_to_process(directories))
+        if self.profiler is not None:
+            fpfiles = self.profiler.timed(u'discovery', fpfiles)
+        if self.args.watch:
+            fpfiles = itertools.ifilter(self.is_unseen_file, fpfiles)
+        if self.index is not None:
+            fpfiles = itertools.ifilter(self.is_new_file, fpfiles)
+        return fpfiles
+
+    def fetch(self, directories=None, fpfiles=None):
+        """Fetch the <fpfiles> (by default the result of discover for
+        <directories>).
+        """
+        if fpfiles is None:
+            fpfiles = self.discover(directories)
+
+        try:
+            if self.destination_index is not None:
+                fpfiles = itertools.ifilter(self.is_unique_file, fpfiles)
+            if self.cfg.getint(u'General', u'READ_AHEAD_FILES') > 0 and not self.args.dryrun:
+                self.readahead = ReadAhead(self.logger,
+                                           self.cfg.getint(u'General', u'READ_AHEAD_FILES'),
+                                           self.cfg.getint(u'General', u'READ_AHEAD_MB') << 20,
+                                           os.stat(self.cfg.get_destdir()).st_dev)
+                fpfiles = self.readahead.prefetch(fpfiles)
+            if self.journal is not None:
+                fpfiles = itertools.imap(self.resume_file, fpfiles)
+            if self.metadata_cache is not None:
+                fpfiles = itertools.imap(self.get_cached_metadata, fpfiles)
+            fpfiles = self.map_files(_initialize_fileinfo, fpfiles)
+            if self.metadata_cache is not None:
+                fpfiles = itertools.imap(self.cache_metadata, fpfiles)
+            fpfiles = itertools.imap(self.claim_destination, fpfiles)
+            if not self.args.dryrun:
+                fpfiles = itertools.imap(self.make_destination_directory, fpfiles)
+                fpfiles = self.map_files(_transform_fileinfo, fpfiles)
+
+            for fpfile in fpfiles:
+                self.logger.debug("----> is file: %s", fpfile.path)
+                source = fpfile.path
 
-            if not self.cfg.getboolean('File_processing', 'KEEP_ORIGINALS'):
                 if self.args.dryrun:
-                    self.logger.info(u"dryrun: not removing source files")
-                else:
-                    fpfile.remove_source_file()
+                    self.logger.info(u"dryrun: not processing picture")
+
+                self.logger.info("%s  -->  %s%s",
+                                 fpfile.path,
+                                 fpfile.get_new_filename(),
+                                 fpfile.get_rotation_type())
+
+                if self.journal is not None and not fpfile.resumed:
+                    self.journal.set_state(fpfile, IngestJournal.COPIED)
+                if not self.args.dryrun and not fpfile.verify_destination(self.args.paranoid):
+                    self.logger.error(u"%s was not written correctly, keeping %s",
+                                      fpfile.get_new_filename(), fpfile.path)
+                    self.failed_directories.add(os.path.normpath(os.path.dirname(source)))
+                    continue
+                if self.journal is not None:
+                    self.journal.set_state(fpfile, IngestJournal.VERIFIED)
+                if self.manifest is not None:
+                    self.manifest.add(fpfile)
+
+                if self.args.watch:
+                    self.fetched_files.add((os.path.abspath(source), fpfile.size, fpfile.mtime))
+                if self.index is not None and not self.args.dryrun:
+                    self.index.add(fpfile)
+                if self.destination_index is not None and not self.args.dryrun:
+                    self.destination_index.add(fpfile)
+
+                if self.profiler is not None:
+                    self.profiler.add_file(fpfile, source)
+
+                if not self.cfg.getboolean('File_processing', 'KEEP_ORIGINALS'):
+                    if self.args.dryrun:
+                        self.logger.info(u"dryrun: not removing source files")
+                    else:
+                        self.queue_removal(fpfile, source)
+
+            self.remove_sources()
+
+            if self.index is not None and not self.args.dryrun:
+                self.add_walked_directories()
+            if self.journal is not None:
+                self.journal.clear()
+        finally:
+            if self.readahead is not None:
+                self.readahead.close()
+                self.readahead = None
+
+    def add_walked_directories(self):
+        """Record the directories searched by this run as fetched, except
+        those with a file which was not written correctly (their files are
+        fetched again next time).
+        """
+        for directory, mtime, entries in self.walked_directories:
+            if os.path.normpath(directory) not in self.failed_directories:
+                self.index.add_directory(directory, mtime, entries)
+
+    def new_fileinfo(self, filename, status, handler):
+        """Return the <handler> object for <filename>."""
+        fpfile = handler(filename, self.logger, self.cfg, status)
+        fpfile.compute_digest = self.manifest is not None or self.args.paranoid
+        return fpfile
+
+    def queue_removal(self, fpfile, source):
+        """Remember that the source of <fpfile> (whose destination was
+        checked) is to be removed.  Depending on REMOVE_ORIGINALS, the
+        sources are removed right away, when the next file is from another
+        directory, or at the end of the run: removing files one by one
+        between the copies makes the card update its file table each time.
+        """
+        mode = self.cfg.get_removal_mode()
+        if mode == u'directory' and self.removals and \
+           os.path.dirname(self.removals[-1][1]) != os.path.dirname(source):
+            self.remove_sources()
+
+        self.removals.append((fpfile, source))
+        if mode == u'file':
+            self.remove_sources()
+
+    def remove_sources(self):
+        """Remove the queued sources.  Before that, the directories of their
+        destinations are written to disk, once per directory.
+        """
+        if not self.removals:
+            return
+
+        start = time.time()
+        for directory in set(os.path.dirname(fpfile.get_new_filename())
+                             for fpfile, dummy_source in self.removals if not fpfile.moved):
+            FileCopier.sync(directory)
+
+        for fpfile, source in self.removals:
+            fpfile.remove_source_file()
+            if self.journal is not None:
+                self.journal.set_state(fpfile, IngestJournal.REMOVED, source)
+
+        elapsed = time.time() - start
+        self.logger.debug(u"removed %d files in %.2f s", len(self.removals), elapsed)
+        if self.profiler is not None:
+            self.profiler.add_duration(u'remove', elapsed)
+        self.removed += len(self.removals)
+        self.removal_time += elapsed
+        self.removals = []
+
+    def is_unseen_file(self, fpfile):
+        """Return False if <fpfile> was fetched before by this --watch
+        process.
+        """
+        return (os.path.abspath(fpfile.path), fpfile.size, fpfile.mtime) not in self.fetched_files
+
+    def is_new_file(self, fpfile):
+        """Return False if <fpfile> is in the index of fetched files."""
+        destination = self.index.contains(fpfile)
+        if destination is None:
+            return True
+
+        self.logger.debug(u"%s was fetched before to %s, skipping", fpfile.path, destination)
+        self.skipped += 1
+        return False
+
+    def get_worker_pool(self):
+        """Return a process pool for the --jobs option."""
+        import multiprocessing
+
+        self.logger.debug(u"using %d worker processes", self.jobs)
+        return multiprocessing.Pool(self.jobs)
+
+    def map_files(self, function, fpfiles):
+        """Apply <function> to each of <fpfiles>, in the worker processes if
+        there are any, and return the results in the original order.
+        The files are handed out from this thread (so exceptions and the
+        index stay here), with at most self.window of them in flight.
+        The worker processes are started with the first file.
+        """
+        if self.jobs == 1:
+            for fpfile in fpfiles:
+                yield function(fpfile)
+            return
+
+        pending = collections.deque()
+        for fpfile in fpfiles:
+            if self.pool is None:
+                self.pool = self.get_worker_pool()
+            pending.append(self.pool.apply_async(function, (fpfile,)))
+            if len(pending) >= self.window:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+
+    def is_unique_file(self, fpfile):
+        """Return False if the content of <fpfile> is already in the
+        destination directory.
+        """
+        duplicate = self.destination_index.find_duplicate(fpfile)
+        if duplicate is None:
+            return True
+
+        self.logger.info(u"%s is already in the destination as %s, skipping",
+                         fpfile.path, duplicate)
+        self.duplicates += 1
+        return False
+
+    def resume_file(self, fpfile):
+        """Continue with <fpfile> where an interrupted run stopped: if its
+        destination was written completely, it is not written again (only
+        the source is removed, if needed).  Otherwise, it is fetched anew.
+        """
+        state, destination, written = self.journal.get(fpfile)
+        if state in (IngestJournal.COPIED, IngestJournal.VERIFIED, IngestJournal.REMOVED) and \
+           os.path.isfile(destination) and os.path.getsize(destination) == written:
+            self.logger.debug(u"%s was fetched to %s by an interrupted run", fpfile.path, destination)
+            fpfile.new_path = destination
+            fpfile.written = written
+            fpfile.resumed = True
+        else:
+            self.journal.set_state(fpfile, IngestJournal.DISCOVERED)
+        return fpfile
+
+    def get_cached_metadata(self, fpfile):
+        """Take the orientation and the time of <fpfile> from the metadata
+        cache, if they are there.
+        """
+        if not fpfile.resumed:
+            metadata = self.metadata_cache.get(fpfile)
+            if metadata is not None:
+                self.logger.debug(u"metadata of %s from the cache", fpfile.path)
+                fpfile.orientation, fpfile.time = metadata
+                fpfile.set_new_filename()
+        return fpfile
+
+    def cache_metadata(self, fpfile):
+        """Remember the orientation and the time of <fpfile>."""
+        if not fpfile.resumed:
+            self.metadata_cache.add(fpfile)
+        return fpfile
+
+    def claim_destination(self, fpfile):
+        """Make sure that no two files of this run get the same destination
+        name.  This is decided here (and not in the worker processes), so the
+        names only depend on the order of the files.
+        If a file with that name is in the destination directory already
+        (like after an earlier run on the same card) and has the content of
+        the source, it is taken as the destination, and nothing is written.
+        Otherwise commit_destination compares it with the written file, and
+        only takes another name if they differ (a rotated file can only be
+        compared once it is written).
+        """
+        if fpfile.resumed:
+            self.claimed_destinations.add(fpfile.get_new_filename())
+            return fpfile
+
+        count = 0
+        while fpfile.get_new_filename() in self.claimed_destinations:
+            count += 1
+            fpfile.set_collision_suffix(count)
+
+        if count:
+            self.logger.warning(u"destination name for %s already taken, using %s",
+                                fpfile.path, fpfile.get_new_filename())
+
+        self.claimed_destinations.add(fpfile.get_new_filename())
+        if fpfile.has_same_content(fpfile.get_new_filename()):
+            self.logger.info(u"%s exists already with the same content",
+                             fpfile.get_new_filename())
+            fpfile.written = fpfile.size
+            fpfile.destination_hash = fpfile.get_content_hash()
+            fpfile.resumed = True
+        return fpfile
+
+    def make_destination_directory(self, fpfile):
+        """Create the directory of the destination of <fpfile> (from
+        DESTINATION_LAYOUT) when it is needed for the first time, or remove
+        the temporary files which interrupted runs left there.  The
+        directories known to exist are remembered, so this is done once per
+        directory and not once per file.
+        """
+        directory = os.path.dirname(fpfile.get_new_filename())
+        if directory not in self.existing_directories:
+            if not os.path.isdir(directory):
+                self.logger.debug(u"creating directory %s", directory)
+                try:
+                    os.makedirs(directory)
+                except OSError, ex:
+                    if ex.errno != errno.EEXIST:
+                        raise
+            else:
+                self.remove_temporary_files(directory)
+            self.existing_directories.add(directory)
+        return fpfile
+
+    def remove_temporary_files(self, directory):
+        """Remove the files in <directory> which interrupted runs were
+        writing (see FPFileInfo.is_stale_temporary_file).
+        """
+        for name in os.listdir(directory):
+            if FPFileInfo.is_stale_temporary_file(directory, name):
+                self.logger.info(u"removing %s, left by an interrupted run",
+                                 os.path.join(directory, name))
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError, ex:
+                    if ex.errno != errno.ENOENT:
+                        raise
 
 def main(argv):
     """Main routine for fetchphotos"""
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+benchmark
+~~~~~~~~~
+
+This file contains the benchmarks for the fetchphotos project.  It
+generates a synthetic camera card (JPEG files with a mix of orientations,
+with and without EXIF data, in nested DCIM folders), and measures the
+throughput and the peak memory use of fetchphotos on it: end to end, and
+for the single stages FPFileInfo.initialize_exifdata and
+FPFileInfo.rotate_and_copy_picture.  It also measures the startup time:
+importing fetchphotos, "fetchphotos.py --version", and a run on an empty
+card.
+"""
+
+## invoke the benchmarks using the call_benchmark.sh script in this directory
+
+#pylint: disable=invalid-name
+
+import argparse
+import datetime
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+import fetchphotos
+
+CONFIG_TEMPLATE = u'''
+[General]
+DIGICAMDIR={src}
+DESTINATIONDIR={dst}
+[File_processing]
+KEEP_ORIGINALS=true
+'''
+
+## the orientations of the generated files, in this proportion
+ORIENTATIONS = (1, 1, 1, 1, 1, 1, 6, 6, 8, 8)
+
+def exif_segment(orientation, when):
+    """Return an APP1 segment with an orientation and a DateTimeOriginal tag."""
+    timestamp = when.strftime("%Y:%m:%d %H:%M:%S") + "\x00"
+    tiff = (b"II*\x00" + struct.pack("<I", 8) +
+            # IFD0: orientation, pointer to the Exif IFD at offset 38
+            struct.pack("<H", 2) +
+            struct.pack("<HHIHH", 0x0112, 3, 1, orientation, 0) +
+            struct.pack("<HHII", 0x8769, 4, 1, 38) +
+            struct.pack("<I", 0) +
+            # Exif IFD: DateTimeOriginal, stored at offset 56
+            struct.pack("<H", 1) +
+            struct.pack("<HHII", 36867, 2, len(timestamp), 56) +
+            struct.pack("<I", 0) +
+            timestamp)
+    payload = b"Exif\x00\x00" + tiff
+    return b"\xff\xe1" + struct.pack(">H", len(payload) + 2) + payload
+
+def comment_segment(text):
+    """Return a COM segment; it makes every generated file unique."""
+    return b"\xff\xfe" + struct.pack(">H", len(text) + 2) + text
+
+def base_jpeg(width, height, quality):
+    """Return a JPEG image with some structure and some noise."""
+    vertical = Image.linear_gradient("L").resize((width, height))
+    horizontal = vertical.transpose(Image.ROTATE_90).resize((width, height))
+    image = Image.merge("RGB", (horizontal, vertical, Image.effect_noise((width, height), 64)))
+    data = io.BytesIO()
+    image.save(data, "JPEG", quality=quality)
+    return data.getvalue()
+
+def generate_card(directory, count, width, height, quality, exif_ratio, per_folder):
+    """Write <count> JPEG files into DCIM/1xxCANON folders below <directory>.
+    Returns the orientation counts.
+    """
+    random.seed(count)
+    jpeg = base_jpeg(width, height, quality)
+    start = datetime.datetime(2015, 2, 22, 14, 17, 50)
+    counts = {}
+
+    for number in range(count):
+        folder = os.path.join(directory, u"DCIM", u"{}CANON".format(100 + number // per_folder))
+        if number % per_folder == 0:
+            os.makedirs(folder)
+
+        segments = comment_segment(b"fetchphotos benchmark %d" % number)
+        if random.random() < exif_ratio:
+            orientation = random.choice(ORIENTATIONS)
+            segments = exif_segment(orientation,
+                                    start + datetime.timedelta(seconds=number)) + segments
+        else:
+            orientation = None
+        counts[orientation] = counts.get(orientation, 0) + 1
+
+        with open(os.path.join(folder, u"IMG_{:04d}.JPG".format(number)), "wb") as out:
+            out.write(jpeg[:2] + segments + jpeg[2:])
+
+    return counts
+
+def measure(function, *args):
+    """Run <function> in a separate process, so its peak memory use is its
+    own.  Returns its result, the wall-clock seconds and the peak RSS in MB.
+    """
+    results = multiprocessing.Queue()
+
+    def child():
+        start = time.time()
+        result = function(*args)
+        elapsed = time.time() - start
+        results.put((result, elapsed,
+                     resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+    process = multiprocessing.Process(target=child)
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def run_main(cfgfile, jobs):
+    """Benchmark: the complete fetchphotos run"""
+    fetchphotos.main([u"fetchphotos", u"-q", u"-j", unicode(jobs), u"-c", cfgfile])
+    return None
+
+def load_fileinfos(cfgfile):
+    """Return the FPFileInfo objects for the files on the card."""
+    logger = logging.getLogger(u"benchmark")
+    logger.setLevel(logging.CRITICAL)
+    cfg = fetchphotos.FetchphotosConfig(logger, cfgfile)
+    fetchp = fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", cfgfile])
+    return [handler(filename, logger, cfg, status)
+            for filename, status, handler in fetchp.get_files_to_process()]
+
+def run_metadata(cfgfile):
+    """Benchmark: FPFileInfo.initialize_exifdata for all files"""
+    fpfiles = load_fileinfos(cfgfile)
+    for fpfile in fpfiles:
+        fpfile.initialize_exifdata()
+    return None
+
+def run_transform(cfgfile):
+    """Benchmark: FPFileInfo.rotate_and_copy_picture for all files"""
+    fpfiles = load_fileinfos(cfgfile)
+    for fpfile in fpfiles:
+        fpfile.initialize_exifdata()
+    start = time.time()
+    for fpfile in fpfiles:
+        fpfile.rotate_and_copy_picture()
+    return time.time() - start
+
+def measure_startup(command, runs):
+    """Run <command> <runs> times; returns the fastest time in ms."""
+    fastest = None
+    with open(os.devnull, "w") as devnull:
+        for dummy in range(runs):
+            start = time.time()
+            subprocess.check_call(command, stdout=devnull, stderr=devnull)
+            elapsed = 1000 * (time.time() - start)
+            if fastest is None or elapsed < fastest:
+                fastest = elapsed
+    return fastest
+
+def imported_modules():
+    """Return the modules loaded by importing fetchphotos (in a fresh
+    interpreter).
+    """
+    output = subprocess.check_output(
+        [sys.executable, "-c",
+         "import sys; before = set(sys.modules); import fetchphotos; " +
+         "print(' '.join(sorted(set(sys.modules) - before)))"])
+    return output.split()
+
+def clear_directory(directory):
+    """Remove the files written by the previous benchmark."""
+    shutil.rmtree(directory)
+    os.makedirs(directory)
+
+def total_size(directory):
+    """Return the size of all files below <directory>, in MB."""
+    size = 0
+    for dirpath, dummy_dirnames, filenames in os.walk(directory):
+        for name in filenames:
+            size += os.path.getsize(os.path.join(dirpath, name))
+    return size / 1024.0 / 1024.0
+
+def main():
+    """Main routine for the benchmarks"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--files", type=int, default=200,
+                        help="number of files on the card")
+    parser.add_argument("--width", type=int, default=1600)
+    parser.add_argument("--height", type=int, default=1200)
+    parser.add_argument("--quality", type=int, default=90,
+                        help="JPEG quality of the generated files")
+    parser.add_argument("--exif-ratio", type=float, default=0.9,
+                        help="share of the files with EXIF data")
+    parser.add_argument("--per-folder", type=int, default=100,
+                        help="files per DCIM subfolder")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="--jobs for the end-to-end run")
+    parser.add_argument("--startup-runs", type=int, default=10,
+                        help="runs per startup benchmark (the fastest one counts)")
+    parser.add_argument("--json", metavar="FILE",
+                        help="append the results as a JSON line to FILE")
+    parser.add_argument("--keep-tempdir", action="store_true")
+    options = parser.parse_args()
+
+    tempdir = tempfile.mkdtemp(prefix="fetchphotos-benchmark-")
+    srcdir = os.path.join(tempdir, u"src")
+    dstdir = os.path.join(tempdir, u"dst")
+    cfgfile = os.path.join(tempdir, u"config.cfg")
+    os.makedirs(dstdir)
+    with open(cfgfile, "w") as out:
+        out.write(CONFIG_TEMPLATE.format(src=srcdir, dst=dstdir))
+
+    try:
+        counts = generate_card(srcdir, options.files, options.width, options.height,
+                               options.quality, options.exif_ratio, options.per_folder)
+        card_size = total_size(srcdir)
+        print "card: {} files, {:.1f} MB, orientations {}".format(
+            options.files, card_size,
+            ", ".join("{}: {}".format(key or "no EXIF", value)
+                      for key, value in sorted(counts.items())))
+
+        results = {u"files": options.files, u"size": card_size,
+                   u"width": options.width, u"height": options.height,
+                   u"jobs": options.jobs, u"version": fetchphotos.Fetchphotos.PROG_VERSION_NUMBER}
+        print "{:<12} {:>9} {:>10} {:>9} {:>9}".format(
+            "benchmark", "seconds", "files/s", "MB/s", "peak MB")
+
+        for name, function, args in (
+                (u"metadata", run_metadata, (cfgfile,)),
+                (u"transform", run_transform, (cfgfile,)),
+                (u"end-to-end", run_main, (cfgfile, options.jobs))):
+            result, elapsed, peak = measure(function, *args)
+            if result is not None:
+                elapsed = result
+            clear_directory(dstdir)
+
+            results[name] = {u"seconds": elapsed, u"peak_rss_mb": peak}
+            print "{:<12} {:>9.2f} {:>10.1f} {:>9.1f} {:>9.1f}".format(
+                name, elapsed, options.files / elapsed, card_size / elapsed, peak)
+
+        emptydir = os.path.join(tempdir, u"empty")
+        emptycfg = os.path.join(tempdir, u"empty.cfg")
+        os.makedirs(emptydir)
+        with open(emptycfg, "w") as out:
+            out.write(CONFIG_TEMPLATE.format(src=emptydir, dst=dstdir))
+
+        script = os.path.splitext(fetchphotos.__file__)[0] + ".py"
+        modules = imported_modules()
+        print "import fetchphotos loads {} modules, PIL: {}".format(
+            len(modules), "yes" if "PIL" in modules else "no")
+        results[u"startup"] = {u"modules": len(modules)}
+        print "{:<12} {:>9}".format("startup", "ms")
+        for name, command in (
+                (u"import", [sys.executable, "-c", "import fetchphotos"]),
+                (u"--version", [sys.executable, script, "--version"]),
+                (u"empty card", [sys.executable, script, "-q", "-c", emptycfg])):
+            elapsed = measure_startup(command, options.startup_runs)
+            results[u"startup"][name] = elapsed
+            print "{:<12} {:>9.1f}".format(name, elapsed)
+
+        if options.json:
+            with open(options.json, "a") as out:
+                out.write(json.dumps(results) + "\n")
+    finally:
+        if options.keep_tempdir:
+            print "files are in", tempdir
+        else:
+            shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+#!/bin/sh
+cd ..
+PYTHONPATH=".:" tests/benchmark.py "$@"
+
+#end
@@ -12,10 +12,25 @@ This file contains the unit tests for the fetchphotos project.
 ## invoke tests using the call_tests.sh script in this directory
 
 import ConfigParser
+from distutils.spawn import find_executable
+import datetime
 import fetchphotos
+import json
 import logging
+import multiprocessing
 import os
+from PIL import Image
+import pickle
 import re
+import shutil
+import socket
+import StringIO
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
 # # Adapted from: http://stackoverflow.com/a/22434262
@@ -169,6 +184,767 @@ class TestConfigCheckers(unittest.TestCase):
     def tearDown(self):
         fetchphotos.FetchphotosConfig.initialize = self.old_init
 
+class TestIngest(unittest.TestCase):
+    """Tests for the per-file ingest steps, using a scratch source and
+    destination directory.
+    """
+    def setUp(self):
+        """Copy the example images and write a matching configuration file"""
+        logging.basicConfig(level=logging.DEBUG)
+        self.logger = logging.getLogger(u"Tester")
+        self.logger.setLevel(logging.CRITICAL)
+
+        self.tempdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tempdir, u"src")
+        self.dstdir = os.path.join(self.tempdir, u"dst")
+        shutil.copytree(u"tests/testdata/example_images", self.srcdir)
+        os.makedirs(self.dstdir)
+
+        self.cfgfile = os.path.join(self.tempdir, u"config.cfg")
+        with open(self.cfgfile, "w") as out:
+            out.write(u"[General]\nDIGICAMDIR={}\nDESTINATIONDIR={}\n".format(
+                self.srcdir, self.dstdir))
+
+        self.fpc = fetchphotos.FetchphotosConfig(self.logger, self.cfgfile)
+
+    def fileinfo(self, name):
+        """Return a FPFileInfo for an example image"""
+        return fetchphotos.FPFileInfo(os.path.join(self.srcdir, name),
+                                      self.logger, self.fpc)
+
+    def test_defaults(self):
+        """Settings missing in the configuration file get their default"""
+        self.assertTrue(self.fpc.getboolean('File_processing', 'KEEP_ORIGINALS'))
+
+    def test_pickle_fileinfo(self):
+        """FPFileInfo objects can be handed to worker processes"""
+        fpfile = self.fileinfo(u"IMG_0533_normal_top_left.JPG")
+        fpfile.initialize_exifdata()
+        copied = pickle.loads(pickle.dumps(fpfile))
+        self.assertEqual(copied.get_new_filename(), fpfile.get_new_filename())
+        self.assertIs(copied.logger, self.logger)
+
+        # the fields are in slots: one record per file stays small
+        raw = fetchphotos.FPRawFileInfo(os.path.join(self.srcdir, u"img_no_metadata.JPG"),
+                                        self.logger, self.fpc)
+        self.assertFalse(hasattr(fpfile, "__dict__") or hasattr(raw, "__dict__"))
+
+    def test_exif_header(self):
+        """The EXIF tags are read without PIL"""
+        tags = fetchphotos.ExifHeader.read_tags(
+            os.path.join(self.srcdir, u"IMG_0535_left_bottom_-_right_is_top.JPG"))
+        self.assertEqual(tags[0x0112], 8)
+        self.assertEqual(tags[36867], b"2009:04:22 17:25:44")
+
+        self.assertIsNone(fetchphotos.ExifHeader.read_tags(
+            os.path.join(self.srcdir, u"img_no_metadata.JPG")))
+
+    def test_exif_header_bad_link(self):
+        """A broken link to the thumbnail IFD does not lose the other tags"""
+        for link in (0, 0x100000):
+            tiff = b"II" + struct.pack("<HI", 42, 8) + \
+                   struct.pack("<H", 1) + struct.pack("<HHIHxx", 0x0112, 3, 1, 6) + \
+                   struct.pack("<I", link)
+            self.assertEqual(fetchphotos.ExifHeader.parse(tiff), {0x0112: 6})
+
+    def test_raw_header(self):
+        """ORF and RW2 files, whose TIFF header has its own magic number, are read"""
+        for name, magic in ((u"P1010001.ORF", 0x4f52), (u"P1010002.RW2", 0x55)):
+            raw = b"II" + struct.pack("<HI", magic, 8) + \
+                  struct.pack("<H", 1) + struct.pack("<HHII", 36867, 2, 20, 26) + \
+                  struct.pack("<I", 0) + b"2015:02:22 14:17:50\0"
+            with open(os.path.join(self.srcdir, name), "wb") as out:
+                out.write(raw)
+            fpfile = fetchphotos.FPRawFileInfo(os.path.join(self.srcdir, name),
+                                               self.logger, self.fpc)
+            fpfile.initialize_exifdata()
+            self.assertEqual(fpfile.time, datetime.datetime(2015, 2, 22, 14, 17, 50))
+
+    def test_set_orientation(self):
+        """The orientation tag is overwritten in place"""
+        filename = os.path.join(self.srcdir, u"IMG_0535_left_bottom_-_right_is_top.JPG")
+        self.assertTrue(fetchphotos.ExifHeader.set_orientation(filename, 1))
+        self.assertEqual(fetchphotos.ExifHeader.read_tags(filename)[0x0112], 1)
+        # the same value is not written again
+        self.assertFalse(fetchphotos.ExifHeader.set_orientation(filename, 1))
+
+        self.assertFalse(fetchphotos.ExifHeader.set_orientation(
+            os.path.join(self.srcdir, u"img_no_metadata.JPG"), 1))
+
+    def test_rotate_fallback(self):
+        """Without lossless rotation, PIL does the rotation"""
+        self.fpc.config.set('File_processing', 'LOSSLESS_ROTATION', 'false')
+        fpfile = self.fileinfo(u"IMG_0535_left_bottom_-_right_is_top.JPG")
+        fpfile.initialize_exifdata()
+        fpfile.rotate_and_copy_picture()
+        self.assertTrue(os.path.isfile(fpfile.get_new_filename()))
+        self.assertNotIn(u"lossless", fpfile.get_rotation_type())
+
+    def test_rotate_metadata(self):
+        """ROTATE_PHOTOS=metadata copies the file and only touches the tag"""
+        self.fpc.config.set('File_processing', 'ROTATE_PHOTOS', 'metadata')
+        fpfile = self.fileinfo(u"IMG_0534_right_top_-_left_ is_top.JPG")
+        fpfile.initialize_exifdata()
+        fpfile.rotate_and_copy_picture()
+        self.assertEqual(os.path.getsize(fpfile.path),
+                         os.path.getsize(fpfile.get_new_filename()))
+        self.assertEqual(fetchphotos.ExifHeader.read_tags(
+            fpfile.get_new_filename())[0x0112], 6)
+        # the tag had the right value: the copy is unchanged
+        self.assertEqual(fpfile.get_rotation_type(), u"")
+        self.assertTrue(fetchphotos.FPFileInfo.same_content(fpfile.path, fpfile.get_new_filename()))
+
+    @unittest.skipUnless(find_executable("jpegtran"), "jpegtran is not installed")
+    def test_rotate_lossless(self):
+        """jpegtran rotates, and the EXIF orientation is reset"""
+        self.fpc.config.set('File_processing', 'LOSSLESS_ROTATION', 'trim')
+        fpfile = self.fileinfo(u"IMG_0535_left_bottom_-_right_is_top.JPG")
+        fpfile.initialize_exifdata()
+        fpfile.rotate_and_copy_picture()
+        self.assertIn(u"lossless", fpfile.get_rotation_type())
+        self.assertEqual(fetchphotos.ExifHeader.read_tags(
+            fpfile.get_new_filename())[0x0112], 1)
+
+    def test_ingest_index(self):
+        """Files in the index are skipped in later runs"""
+        with open(self.cfgfile, "a") as out:
+            out.write(u"SKIP_FETCHED=true\nINDEX_FILE={}\n".format(
+                os.path.join(self.tempdir, u"index.sqlite")))
+
+        fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile]).main()
+        for name in os.listdir(self.dstdir):
+            os.unlink(os.path.join(self.dstdir, name))
+
+        fetchp = fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-j", u"2",
+                                          u"-c", self.cfgfile])
+        fetchp.main()
+        self.assertEqual(os.listdir(self.dstdir), [])
+        self.assertEqual(fetchp.skipped, 4)
+
+    def test_skip_duplicates(self):
+        """Files whose content is already in the destination are not copied"""
+        with open(self.cfgfile, "a") as out:
+            out.write(u"SKIP_DUPLICATES=true\nINDEX_FILE={}\n".format(
+                os.path.join(self.tempdir, u"index.sqlite")))
+        shutil.copy(os.path.join(self.srcdir, u"IMG_0533_normal_top_left.JPG"),
+                    os.path.join(self.dstdir, u"old.jpg"))
+        fetchp = fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile])
+        fetchp.main()
+        self.assertEqual(fetchp.duplicates, 1)
+        self.assertEqual(len(os.listdir(self.dstdir)), 4)
+
+        # the rotated copies are recognised by the content of their source
+        fetchp = fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile])
+        fetchp.main()
+        self.assertEqual(fetchp.duplicates, 4)
+
+    def test_files_to_process(self):
+        """The files are found one by one, with their stat() result"""
+        os.makedirs(os.path.join(self.srcdir, u"directory.jpg"))
+        fetchp = fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile])
+        files = fetchp.get_files_to_process()
+        filename, status, handler = next(files)
+        self.assertEqual(os.path.basename(filename), u"IMG_0533_normal_top_left.JPG")
+        self.assertEqual(status.st_size, os.path.getsize(filename))
+        self.assertIs(handler, fetchphotos.FPFileInfo)
+        self.assertEqual(len(list(files)), 3)
+
+    def test_extension_registry(self):
+        """Subdirectories are searched, and the extensions select the handler"""
+        subdir = os.path.join(self.srcdir, u"DCIM", u"100CANON")
+        os.makedirs(subdir)
+        shutil.copy(os.path.join(self.srcdir, u"IMG_0533_normal_top_left.JPG"),
+                    os.path.join(subdir, u"IMG_0001.JPG"))
+        with open(os.path.join(subdir, u"MVI_0002.MOV"), "w") as out:
+            out.write(u"not really a video")
+        with open(self.cfgfile, "a") as out:
+            out.write(u"VIDEO_EXTENSIONS=mov, avi\n")
+
+        fetchp = fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile])
+        found = dict((os.path.basename(filename), handler)
+                     for filename, dummy, handler in fetchp.get_files_to_process())
+        self.assertIs(found[u"IMG_0001.JPG"], fetchphotos.FPFileInfo)
+        self.assertIs(found[u"MVI_0002.MOV"], fetchphotos.FPVideoFileInfo)
+        self.assertEqual(len(found), 6)
+
+    def test_video(self):
+        """Videos are named after the creation time in their movie header"""
+        created = datetime.datetime(2015, 2, 22, 14, 17, 50)
+        seconds = int(time.mktime(created.timetuple())) + fetchphotos.QuickTimeHeader.EPOCH_OFFSET
+        mvhd = struct.pack(">B3xII", 0, seconds, seconds) + b"\0" * 88
+        moov = struct.pack(">I4s", 8 + 8 + len(mvhd), b"moov") + \
+               struct.pack(">I4s", 8 + len(mvhd), b"mvhd") + mvhd
+        # a media data box with a 64 bit size
+        mdat = struct.pack(">I4sQ", 1, b"mdat", 16 + 1000) + b"\x42" * 1000
+        movie = struct.pack(">I4s4s", 12, b"ftyp", b"qt  ") + mdat + moov
+        with open(os.path.join(self.srcdir, u"MVI_0002.MOV"), "wb") as out:
+            out.write(movie)
+        with open(self.cfgfile, "a") as out:
+            out.write(u"VIDEO_EXTENSIONS=mov\n")
+
+        fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile]).main()
+        with open(os.path.join(self.dstdir, u"2015-02-22T14.17.50_mvi_0002.mov"), "rb") as clip:
+            self.assertEqual(clip.read(), movie)
+
+    def test_skip_fetched_directories(self):
+        """Directories which were fetched completely are not searched again"""
+        with open(self.cfgfile, "a") as out:
+            out.write(u"SKIP_FETCHED=true\nSKIP_FETCHED_DIRECTORIES=true\n" +
+                      u"INDEX_FILE={}\n".format(os.path.join(self.tempdir, u"index.sqlite")))
+
+        fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile]).main()
+        fetchp = fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile])
+        fetchp.main()
+        self.assertEqual(fetchp.skipped, 0)
+        self.assertEqual(fetchp.walked_directories, [])
+
+    def test_skip_fetched_directories_nested(self):
+        """A new file in a subdirectory of a fetched directory is found"""
+        with open(self.cfgfile, "a") as out:
+            out.write(u"SKIP_FETCHED=true\nSKIP_FETCHED_DIRECTORIES=true\n" +
+                      u"INDEX_FILE={}\n".format(os.path.join(self.tempdir, u"index.sqlite")))
+        subdir = os.path.join(self.srcdir, u"DCIM", u"100CANON")
+        os.makedirs(subdir)
+        shutil.copy(os.path.join(self.srcdir, u"img_no_metadata.JPG"),
+                    os.path.join(subdir, u"IMG_0001.JPG"))
+        fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile]).main()
+
+        shutil.copy(os.path.join(self.srcdir, u"IMG_0533_normal_top_left.JPG"),
+                    os.path.join(subdir, u"IMG_0002.JPG"))
+        fetchp = fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile])
+        fetchp.main()
+        self.assertEqual(fetchp.skipped, 1)
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.dstdir, u"2009-04-22T17.25.35_img_0002.jpg")))
+
+        # a directory with a file that was not written correctly is searched again
+        os.remove(os.path.join(subdir, u"IMG_0001.JPG"))
+        os.remove(os.path.join(self.dstdir, u"2009-04-22T17.25.35_img_0002.jpg"))
+        shutil.copy(os.path.join(self.srcdir, u"IMG_0533_normal_top_left.JPG"),
+                    os.path.join(subdir, u"IMG_0003.JPG"))
+        fetchp = fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile])
+        verify_destination = fetchphotos.FPFileInfo.verify_destination
+        fetchphotos.FPFileInfo.verify_destination = lambda self, paranoid=False: False
+        try:
+            fetchp.main()
+        finally:
+            fetchphotos.FPFileInfo.verify_destination = verify_destination
+        self.assertEqual(fetchp.failed_directories, set([subdir]))
+        index = fetchphotos.IngestIndex(os.path.join(self.tempdir, u"index.sqlite"), self.logger)
+        self.assertFalse(index.is_imported_directory(subdir, os.stat(subdir).st_mtime, 2))
+        self.assertTrue(index.is_imported_directory(self.srcdir, os.stat(self.srcdir).st_mtime,
+                                                   len(os.listdir(self.srcdir))))
+        index.close()
+
+    def test_file_copier(self):
+        """Files are copied with their content and permissions"""
+        source = os.path.join(self.srcdir, u"IMG_0533_normal_top_left.JPG")
+        os.chmod(source, 0o640)
+        with open(source, 'rb') as original:
+            content = original.read()
+
+        old_libc = fetchphotos.FileCopier.libc
+        try:
+            for libc in (None, False):
+                fetchphotos.FileCopier.libc = libc
+                destination = os.path.join(self.dstdir, u"copy{}.jpg".format(libc))
+                fetchphotos.FileCopier.copy(source, destination)
+                with open(destination, 'rb') as copied:
+                    self.assertEqual(copied.read(), content)
+                self.assertEqual(os.stat(destination).st_mode & 0o777, 0o640)
+        finally:
+            fetchphotos.FileCopier.libc = old_libc
+
+    def test_file_copier_nothing_copied(self):
+        """If the kernel copies nothing, the data is copied by fetchphotos"""
+        class NothingCopied(object):
+            """A C library whose copy functions copy 0 bytes"""
+            @staticmethod
+            def fallocate(dummy_descriptor, dummy_mode, dummy_offset, dummy_length):
+                return -1
+
+            @staticmethod
+            def copy_file_range(*dummy_args):
+                return 0
+
+            @staticmethod
+            def sendfile(*dummy_args):
+                return 0
+
+        source = os.path.join(self.srcdir, u"IMG_0533_normal_top_left.JPG")
+        destination = os.path.join(self.dstdir, u"copy.jpg")
+        old_libc = fetchphotos.FileCopier.libc
+        try:
+            fetchphotos.FileCopier.libc = NothingCopied()
+            self.assertEqual(fetchphotos.FileCopier.copy(source, destination), u"read/write")
+        finally:
+            fetchphotos.FileCopier.libc = old_libc
+        self.assertTrue(fetchphotos.FPFileInfo.same_content(source, destination))
+
+    def test_move_files(self):
+        """Without KEEP_ORIGINALS, unrotated files are renamed"""
+        with open(self.cfgfile, "a") as out:
+            out.write(u"[File_processing]\nKEEP_ORIGINALS=false\n")
+        source = os.path.join(self.srcdir, u"IMG_0533_normal_top_left.JPG")
+        inode = os.stat(source).st_ino
+
+        fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile]).main()
+        self.assertEqual([name for name in os.listdir(self.srcdir)
+                          if name.lower().endswith(u".jpg")], [])
+        self.assertEqual(len(os.listdir(self.dstdir)), 4)
+        self.assertEqual(os.stat(os.path.join(
+            self.dstdir, u"2009-04-22T17.25.35_img_0533_normal_top_left.jpg")).st_ino, inode)
+
+    def test_move_and_set_orientation(self):
+        """Moved files whose orientation tag is set are indexed by their destination"""
+        with open(self.cfgfile, "a") as out:
+            out.write(u"SKIP_FETCHED=true\nINDEX_HASH=true\nSKIP_DUPLICATES=true\n" +
+                      u"[File_processing]\nKEEP_ORIGINALS=false\nROTATE_PHOTOS=metadata\n")
+        # an invalid orientation is set to normal, upside down is kept
+        fetchphotos.ExifHeader.set_orientation(
+            os.path.join(self.srcdir, u"IMG_0533_normal_top_left.JPG"), 9)
+        fetchphotos.ExifHeader.set_orientation(
+            os.path.join(self.srcdir, u"IMG_0535_left_bottom_-_right_is_top.JPG"), 3)
+
+        fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile]).main()
+        destination = os.path.join(self.dstdir, u"2009-04-22T17.25.35_img_0533_normal_top_left.jpg")
+        self.assertEqual(fetchphotos.ExifHeader.read_tags(destination)[0x0112], 1)
+        self.assertEqual(fetchphotos.ExifHeader.read_tags(os.path.join(
+            self.dstdir, u"2009-04-22T17.25.44_img_0535_left_bottom_-_right_is_top.jpg"))[0x0112], 3)
+
+        index = fetchphotos.DestinationIndex(self.fpc.get_index_filename(), self.dstdir, self.logger)
+        self.assertEqual(index.db.execute(u"SELECT size, hash FROM destination WHERE path=?",
+                                          (destination,)).fetchone(),
+                         (os.path.getsize(destination), None))
+        index.close()
+
+    def test_resume(self):
+        """Files copied by an interrupted run are not copied again"""
+        fpfile = self.fileinfo(u"IMG_0533_normal_top_left.JPG")
+        fpfile.initialize_exifdata()
+        fpfile.rotate_and_copy_picture()
+        fpfile.written = os.path.getsize(fpfile.get_new_filename())
+        inode = os.stat(fpfile.get_new_filename()).st_ino
+        journal = fetchphotos.IngestJournal(self.fpc.get_index_filename(), self.logger)
+        journal.set_state(fpfile, fetchphotos.IngestJournal.COPIED)
+        journal.close()
+
+        with open(self.cfgfile, "a") as out:
+            out.write(u"JOURNAL=true\n[File_processing]\nKEEP_ORIGINALS=false\n")
+        fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile]).main()
+        self.assertEqual([name for name in os.listdir(self.srcdir)
+                          if name.lower().endswith(u".jpg")], [])
+        self.assertEqual(len(os.listdir(self.dstdir)), 4)
+        self.assertEqual(os.stat(fpfile.get_new_filename()).st_ino, inode)
+
+        journal = fetchphotos.IngestJournal(self.fpc.get_index_filename(), self.logger)
+        self.assertEqual(journal.get(fpfile), (None, None, None))
+        journal.close()
+
+    def test_resume_after_kill(self):
+        """The journal survives a run which is killed"""
+        with open(self.cfgfile, "a") as out:
+            out.write(u"JOURNAL=true\n")
+        script = u"""
+import os, signal, sys, fetchphotos
+set_state = fetchphotos.IngestJournal.set_state
+def killing_set_state(self, fpfile, state, source=None):
+    set_state(self, fpfile, state, source)
+    if state == fetchphotos.IngestJournal.COPIED and fpfile.path.endswith(u"0534_right_top_-_left_ is_top.JPG"):
+        os.kill(os.getpid(), signal.SIGKILL)
+fetchphotos.IngestJournal.set_state = killing_set_state
+fetchphotos.main([u"fetchphotos", u"-q", u"-c", sys.argv[1]])
+"""
+        child = subprocess.Popen([sys.executable, u"-c", script, self.cfgfile],
+                                 env=dict(os.environ, PYTHONPATH=os.path.dirname(
+                                     os.path.abspath(fetchphotos.__file__))))
+        self.assertEqual(child.wait(), -9)
+
+        journal = fetchphotos.IngestJournal(self.fpc.get_index_filename(), self.logger)
+        for name in (u"IMG_0533_normal_top_left.JPG", u"IMG_0534_right_top_-_left_ is_top.JPG"):
+            self.assertIn(journal.get(self.fileinfo(name))[0],
+                          (fetchphotos.IngestJournal.COPIED, fetchphotos.IngestJournal.VERIFIED))
+        journal.close()
+
+        fetchp = fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile])
+        resumed = []
+        resume_file = fetchp.resume_file
+        def record_resumed(fpfile):
+            fpfile = resume_file(fpfile)
+            if fpfile.resumed:
+                resumed.append(os.path.basename(fpfile.path))
+            return fpfile
+        fetchp.resume_file = record_resumed
+        fetchp.main()
+        self.assertEqual(resumed, [u"IMG_0533_normal_top_left.JPG",
+                                   u"IMG_0534_right_top_-_left_ is_top.JPG"])
+        self.assertEqual(len(os.listdir(self.dstdir)), 4)
+
+    def test_unwritable_index(self):
+        """A journal and a metadata cache which can't be opened are left out"""
+        with open(self.cfgfile, "a") as out:
+            out.write(u"JOURNAL=true\nINDEX_FILE={}\n".format(
+                os.path.join(self.tempdir, u"missing", u"index.sqlite")))
+        fetchp = fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile])
+        fetchp.main()
+        self.assertIsNone(fetchp.journal)
+        self.assertIsNone(fetchp.metadata_cache)
+        self.assertEqual(len(os.listdir(self.dstdir)), 4)
+
+    def test_watch(self):
+        """With --watch, files are fetched once, and new files are noticed"""
+        fetchp = fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-w", u"-c", self.cfgfile])
+        fetchp.fetch()
+        fetchp.fetch()
+        self.assertEqual(len(os.listdir(self.dstdir)), 4)
+
+        folder = os.path.join(self.srcdir, u"DCIM")
+        os.mkdir(folder)
+        card = os.path.join(self.tempdir, u"card")
+        for directory, expected in ((self.srcdir, [folder]), (card, None)):
+            watcher = fetchphotos.SourceWatcher(self.logger, directory)
+            if watcher.descriptor is None:
+                self.skipTest(u"inotify is not available")
+            watcher.SETTLE_TIME = 0.1
+            if expected is None:
+                timer = threading.Timer(0.1, os.mkdir, [card])
+            else:
+                timer = threading.Timer(0.1, shutil.copy, [
+                    os.path.join(self.srcdir, u"img_no_metadata.JPG"), folder])
+            timer.start()
+            self.assertEqual(watcher.wait(), expected)
+            timer.join()
+            watcher.close()
+
+        # deleted directories are left out
+        gone, other = os.path.join(folder, u"100CANON"), os.path.join(folder, u"101CANON")
+        os.mkdir(gone)
+        os.mkdir(other)
+        watcher = fetchphotos.SourceWatcher(self.logger, self.srcdir)
+        watcher.SETTLE_TIME = 0.1
+
+        def change():
+            shutil.rmtree(gone)
+            shutil.copy(os.path.join(self.srcdir, u"img_no_metadata.JPG"), other)
+        timer = threading.Timer(0.1, change)
+        timer.start()
+        self.assertEqual(watcher.wait(), [other])
+        timer.join()
+        watcher.close()
+
+    def test_watch_errors(self):
+        """An error while fetching does not end --watch"""
+        fetchp = fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-w", u"-c", self.cfgfile])
+        passes = []
+
+        def failing_fetch(directories=None):
+            passes.append(directories)
+            raise OSError(2, u"No such file or directory")
+
+        def stop(dummy_self):
+            if len(passes) > 1:
+                raise KeyboardInterrupt()
+
+        fetchp.fetch = failing_fetch
+        wait = fetchphotos.SourceWatcher.wait
+        fetchphotos.SourceWatcher.wait = stop
+        try:
+            self.assertRaises(KeyboardInterrupt, fetchp.watch)
+        finally:
+            fetchphotos.SourceWatcher.wait = wait
+        self.assertEqual(passes, [None, None])
+
+    def test_remove_sources(self):
+        """Sources are removed in batches per directory"""
+        with open(self.cfgfile, "a") as out:
+            out.write(u"[File_processing]\nKEEP_ORIGINALS=false\n")
+        fetchp = fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile])
+        os.mkdir(os.path.join(self.srcdir, u"DCIM"))
+        os.rename(os.path.join(self.srcdir, u"IMG_0535_left_bottom_-_right_is_top.JPG"),
+                  os.path.join(self.srcdir, u"DCIM", u"IMG_0535_left_bottom_-_right_is_top.JPG"))
+
+        fpfiles = []
+        for name in (u"IMG_0533_normal_top_left.JPG", u"IMG_0534_right_top_-_left_ is_top.JPG",
+                     os.path.join(u"DCIM", u"IMG_0535_left_bottom_-_right_is_top.JPG")):
+            fpfile = self.fileinfo(name)
+            fpfile.initialize_exifdata()
+            fpfile.set_new_filename()
+            fpfile.rotate_and_copy_picture()
+            fpfiles.append(fpfile)
+        sources = [fpfile.path for fpfile in fpfiles]
+
+        fetchp.queue_removal(fpfiles[0], sources[0])
+        fetchp.queue_removal(fpfiles[1], sources[1])
+        self.assertEqual([os.path.exists(source) for source in sources], [True, True, True])
+        fetchp.queue_removal(fpfiles[2], sources[2])
+        self.assertEqual([os.path.exists(source) for source in sources], [False, False, True])
+        fetchp.remove_sources()
+        self.assertEqual([os.path.exists(source) for source in sources], [False, False, False])
+        self.assertEqual(fetchp.removed, 3)
+
+    def test_manifest(self):
+        """The hashes of the written files are recorded and checked"""
+        with open(self.cfgfile, "a") as out:
+            out.write(u"[File_processing]\nKEEP_ORIGINALS=false\nMANIFEST=true\n")
+        fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"--paranoid", u"-c", self.cfgfile]).main()
+
+        manifests = os.listdir(os.path.join(self.dstdir, u".manifests"))
+        self.assertEqual(len(manifests), 1)
+        with open(os.path.join(self.dstdir, u".manifests", manifests[0])) as manifest:
+            entries = [line.rstrip("\n").split("  ", 1) for line in manifest]
+        self.assertEqual(len(entries), 4)
+        for digest, name in entries:
+            self.assertEqual(fetchphotos.FPFileInfo.hash_file(os.path.join(self.dstdir, name)),
+                             digest)
+
+    def test_verify_destination(self):
+        """--paranoid notices a destination which differs from what was written"""
+        fpfile = self.fileinfo(u"IMG_0534_right_top_-_left_ is_top.JPG")
+        fpfile.compute_digest = True
+        fpfile.initialize_exifdata()
+        fpfile.set_new_filename()
+        fpfile.rotate_and_copy_picture()
+        fpfile.written = os.path.getsize(fpfile.get_new_filename())
+        self.assertTrue(fpfile.verify_destination(True))
+
+        with open(fpfile.get_new_filename(), "r+b") as out:
+            out.seek(-3, os.SEEK_END)
+            out.write(b"\x00")
+        self.assertTrue(fpfile.verify_destination())
+        self.assertFalse(fpfile.verify_destination(True))
+
+    def test_startup(self):
+        """Importing fetchphotos, and a run without files, stay light"""
+        output = subprocess.check_output([
+            sys.executable, "-c",
+            "import sys, fetchphotos; " +
+            "print(' '.join(name for name in ('PIL', 'multiprocessing', 'sqlite3', 'subprocess') " +
+            "if name in sys.modules))"])
+        self.assertEqual(output.strip(), "")
+
+        for name in os.listdir(self.srcdir):
+            os.remove(os.path.join(self.srcdir, name))
+        fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-j", u"2", u"-c", self.cfgfile]).main()
+        self.assertFalse(os.path.exists(self.fpc.get_index_filename()))
+
+    def test_startup_fetched_before(self):
+        """A run whose files were all fetched before ends early too"""
+        with open(self.cfgfile, "a") as out:
+            out.write(u"SKIP_FETCHED=true\nSKIP_DUPLICATES=true\n")
+        fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile]).main()
+
+        fetchp = fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-j", u"2", u"-c", self.cfgfile])
+        fetchp.main()
+        self.assertEqual(fetchp.skipped, 4)
+        self.assertIsNone(fetchp.destination_index)
+        self.assertIsNone(fetchp.journal)
+        self.assertIsNone(fetchp.pool)
+
+    def test_metadata_cache(self):
+        """A run after a dry run takes the metadata from the cache"""
+        fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-s", u"-c", self.cfgfile]).main()
+        self.assertEqual(os.listdir(self.dstdir), [])
+
+        # a changed entry shows that the file is not read again
+        fpfile = self.fileinfo(u"IMG_0533_normal_top_left.JPG")
+        cache = fetchphotos.MetadataCache(self.fpc.get_index_filename(), self.logger, 2)
+        self.assertEqual(cache.get(fpfile), (1, datetime.datetime(2009, 4, 22, 17, 25, 35)))
+        fpfile.orientation = 1
+        fpfile.time = datetime.datetime(2001, 1, 1)
+        cache.add(fpfile)
+        cache.close()
+
+        fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile]).main()
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.dstdir, u"2001-01-01T00.00.00_img_0533_normal_top_left.jpg")))
+
+        # only the two files used last are kept
+        cache = fetchphotos.MetadataCache(self.fpc.get_index_filename(), self.logger, 2)
+        cache.close()
+        cache = fetchphotos.MetadataCache(self.fpc.get_index_filename(), self.logger, 2)
+        self.assertEqual(cache.db.execute(u"SELECT COUNT(*) FROM metadata").fetchone()[0], 2)
+        cache.close()
+
+    def test_read_ahead(self):
+        """Files are passed on in order, with a limited look-ahead"""
+        fpfiles = [self.fileinfo(name) for name in sorted(os.listdir(self.srcdir))]
+        readahead = fetchphotos.ReadAhead(self.logger, 2, 1 << 20, None)
+        seen = []
+
+        def source():
+            for fpfile in fpfiles:
+                seen.append(fpfile)
+                yield fpfile
+
+        try:
+            prefetched = readahead.prefetch(source())
+            self.assertIs(next(prefetched), fpfiles[0])
+            self.assertEqual(len(seen), 2)
+            self.assertEqual(list(prefetched), fpfiles[1:])
+        finally:
+            readahead.close()
+        self.assertFalse(readahead.thread.is_alive())
+
+    def test_percentile(self):
+        """Percentiles use the nearest rank"""
+        values = range(1, 101)
+        self.assertEqual(fetchphotos.Profiler.percentile(values, 0.5), 50)
+        self.assertEqual(fetchphotos.Profiler.percentile(values, 0.99), 99)
+        self.assertEqual(fetchphotos.Profiler.percentile([3], 0.95), 3)
+
+    def test_profile(self):
+        """--profile prints a summary, --trace writes JSON lines"""
+        trace = os.path.join(self.tempdir, u"trace.jsonl")
+        fetchp = fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"--profile",
+                                          u"--trace", trace, u"-c", self.cfgfile])
+        old_stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            fetchp.main()
+            report = sys.stdout.getvalue()
+        finally:
+            sys.stdout = old_stdout
+
+        self.assertRegexpMatches(report, r'transform +4 ')
+        self.assertRegexpMatches(report, r'4 files in')
+        with open(trace) as lines:
+            records = [json.loads(line) for line in lines]
+        self.assertEqual(len(records), 5)
+        self.assertIn(u'metadata', records[0])
+        self.assertEqual(records[-1][u'summary'][u'files'], 4)
+
+    def test_decode_budget(self):
+        """Other processes only get the memory that is left"""
+        budget = fetchphotos.DecodeBudget(100, os.path.join(self.tempdir, u"decode.lock"))
+        results = multiprocessing.Queue()
+
+        def other_process(megabytes):
+            with open(budget.filename, 'a') as lockfile:
+                results.put(budget.try_reserve(lockfile, megabytes))
+
+        with budget.reserve(60):
+            for megabytes in (40, 41):
+                child = multiprocessing.Process(target=other_process, args=(megabytes,))
+                child.start()
+                child.join()
+                self.assertEqual(results.get(), 60 if megabytes == 40 else None)
+
+    def test_destination_layout(self):
+        """Files are put into date subdirectories"""
+        with open(self.cfgfile, "a") as out:
+            out.write(u"[File_processing]\nDESTINATION_LAYOUT=%Y/%m-%d\n")
+        fetchp = fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile])
+        fetchp.main()
+
+        # img_no_metadata.JPG goes by the time of the file
+        ctime = datetime.datetime.fromtimestamp(os.stat(os.path.join(self.srcdir,
+                                                                     u"img_no_metadata.JPG")).st_ctime)
+        directories = set([os.path.join(self.dstdir, u"2009", u"04-22"),
+                           os.path.join(self.dstdir, ctime.strftime(u"%Y/%m-%d"))])
+        self.assertEqual(fetchp.existing_directories, directories)
+        self.assertEqual(sum(len(os.listdir(directory)) for directory in directories), 4)
+
+    def test_thumbnails(self):
+        """Upright previews are written for all sizes"""
+        with open(self.cfgfile, "a") as out:
+            out.write(u"[File_processing]\nTHUMBNAIL_SIZES=200, 100\n")
+        fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile]).main()
+
+        thumbnail = os.path.join(self.dstdir, u".thumbnails", u"{}",
+                                 u"2009-04-22T17.25.38_img_0534_right_top_-_left_ is_top.jpg")
+        self.assertEqual(Image.open(thumbnail.format(200)).size, (150, 200))
+        self.assertEqual(Image.open(thumbnail.format(100)).size, (75, 100))
+        self.assertEqual(len(os.listdir(os.path.join(self.dstdir, u".thumbnails", u"100"))), 4)
+
+    def test_claim_destination(self):
+        """Two files with the same destination name don't overwrite each other"""
+        fetchp = fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile])
+        first = self.fileinfo(u"IMG_0533_normal_top_left.JPG")
+        first.initialize_exifdata()
+        second = self.fileinfo(u"IMG_0533_normal_top_left.JPG")
+        second.initialize_exifdata()
+
+        fetchp.claim_destination(first)
+        fetchp.claim_destination(second)
+        self.assertEqual(
+            os.path.basename(second.get_new_filename()),
+            u"2009-04-22T17.25.35_img_0533_normal_top_left_1.jpg")
+
+    def test_fetch_again(self):
+        """Fetching the same card again does not add copies"""
+        for dummy in range(3):
+            fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile]).main()
+        self.assertEqual(len(os.listdir(self.dstdir)), 4)
+
+        # unchanged files are not even written again
+        fpfile = self.fileinfo(u"IMG_0533_normal_top_left.JPG")
+        fpfile.initialize_exifdata()
+        fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile]).claim_destination(fpfile)
+        self.assertTrue(fpfile.resumed)
+        self.assertEqual(os.path.basename(fpfile.get_new_filename()),
+                         u"2009-04-22T17.25.35_img_0533_normal_top_left.jpg")
+
+    def test_commit_destination(self):
+        """Existing files are never overwritten, and no partial files are left"""
+        name = u"2009-04-22T17.25.35_img_0533_normal_top_left{}.jpg"
+        with open(os.path.join(self.dstdir, name.format(u"")), "w") as out:
+            out.write("another photo")
+        fetchp = fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile])
+        fpfile = self.fileinfo(u"IMG_0533_normal_top_left.JPG")
+        fpfile.initialize_exifdata()
+        fetchp.claim_destination(fpfile)
+        self.assertFalse(fpfile.resumed)
+
+        # another process writes the next name in the meantime
+        with open(os.path.join(self.dstdir, name.format(u"_1")), "w") as out:
+            out.write("yet another photo")
+        fpfile.rotate_and_copy_picture()
+        self.assertEqual(os.path.basename(fpfile.get_new_filename()), name.format(u"_2"))
+
+        # the same content is not written twice
+        fpfile = self.fileinfo(u"IMG_0533_normal_top_left.JPG")
+        fpfile.initialize_exifdata()
+        fpfile.set_collision_suffix(2)
+        fpfile.rotate_and_copy_picture()
+        self.assertEqual(os.path.basename(fpfile.get_new_filename()), name.format(u"_2"))
+        self.assertEqual(sorted(os.listdir(self.dstdir)),
+                         [name.format(suffix) for suffix in (u"", u"_1", u"_2")])
+
+    def test_temporary_files(self):
+        """Temporary files of interrupted runs are removed by the next run"""
+        child = subprocess.Popen([sys.executable, u"-c", u"pass"])
+        child.wait()
+        host = socket.gethostname()
+        stale = u".fetchphotos-{}+{}+photo.jpg.abc123.jpg".format(child.pid, host)
+        running = u".fetchphotos-{}+{}+photo.jpg.def456.jpg".format(os.getpid(), host)
+        # from another machine sharing the directory: only removed when old
+        remote = u".fetchphotos-{}+{}-2+photo.jpg.ghi789.jpg".format(child.pid, host)
+        old_remote = u".fetchphotos-{}+{}-2+photo.jpg.jkl012.jpg".format(child.pid, host)
+        for name in (stale, running, remote, old_remote):
+            with open(os.path.join(self.dstdir, name), "w") as out:
+                out.write("partial photo")
+        two_days_ago = time.time() - 2 * 24 * 60 * 60
+        os.utime(os.path.join(self.dstdir, old_remote), (two_days_ago, two_days_ago))
+
+        fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-c", self.cfgfile]).main()
+        names = os.listdir(self.dstdir)
+        self.assertNotIn(stale, names)
+        self.assertNotIn(old_remote, names)
+        self.assertIn(running, names)
+        self.assertIn(remote, names)
+        self.assertEqual(len(names), 6)
+
+    def test_parallel_jobs(self):
+        """--jobs gives the same result as the sequential run"""
+        fetchp = fetchphotos.Fetchphotos([u"fetchphotos", u"-q", u"-j", u"2",
+                                          u"-c", self.cfgfile])
+        fetchp.main()
+        self.assertEqual(len(os.listdir(self.dstdir)),
+                         len([n for n in os.listdir(self.srcdir)
+                              if n.lower().endswith(u".jpg")]))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
 
 if __name__ == '__main__':
     unittest.main()